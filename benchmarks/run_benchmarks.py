@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Plots are rendered without a window
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import src.sql_manager as sql_mgr
+import src.logic_manager as lgc_mgr
+import src.visual_manager as v_mgr
+from synthetic_data import generate_datasets
+
+# Shape of the database tables, the database stages only run for matching data sets
+DB_TRAIN_FUNCTIONS = len(sql_mgr.TABLE_COLUMNS['train_db']) - 1
+DB_IDEAL_FUNCTIONS = len(sql_mgr.TABLE_COLUMNS['ideal_db']) - 1
+
+def time_stage(results, name, function, repeat=1):
+    '''
+    Time a stage and store the best wall time of all repetitions
+
+    :param results: dict to store the seconds of the stage in
+    :param name: name of the stage
+    :param function: function to time, called without arguments
+    :param repeat: amount of repetitions
+    :return: return value of the last call
+    '''
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        value = function()
+        timings.append(time.perf_counter() - start_time)
+    results[name] = min(timings)
+    print(f"{name:<28}{results[name]:>10.4f} s")
+    return value
+
+def run(n_samples, n_ideal, n_train, n_test, repeat, plot):
+    '''
+    Generate a synthetic data set and time every stage of the pipeline on it
+
+    :param n_samples: amount of x samples
+    :param n_ideal: amount of ideal functions
+    :param n_train: amount of training functions
+    :param n_test: amount of test points
+    :param repeat: repetitions of the stages which do not change the database
+    :param plot: if True the plotting stage is timed as well
+    :return: dict with the seconds of every stage
+    '''
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        train_path, ideal_path, test_path = generate_datasets(directory, n_samples, n_ideal, n_train, n_test)
+        db_manager = sql_mgr.DatabaseManager(os.path.join(directory, 'benchmark.db'))
+        db_manager.createDatabase()
+        lgc_manager = lgc_mgr.LogicManager()
+
+        # Database stages need the fixed table layout
+        if n_train == DB_TRAIN_FUNCTIONS and n_ideal == DB_IDEAL_FUNCTIONS:
+            time_stage(stages, 'import_idealCSV', lambda: db_manager.import_idealCSV(ideal_path))
+            time_stage(stages, 'import_trainCSV', lambda: db_manager.import_trainCSV(train_path))
+            dataFrame_ideal = time_stage(stages, 'load_table ideal_db', lambda: db_manager.load_table('ideal_db'), repeat)
+            dataFrame_train = time_stage(stages, 'load_table train_db', lambda: db_manager.load_table('train_db'), repeat)
+        else:
+            print(f"Database stages skipped, tables hold {DB_TRAIN_FUNCTIONS} train and {DB_IDEAL_FUNCTIONS} ideal functions")
+            dataFrame_ideal = db_manager.csv_2DArray(ideal_path)
+            dataFrame_train = db_manager.csv_2DArray(train_path)
+
+        # Fitting
+        ideal_for_train = time_stage(stages, 'get_best_fit_functions',
+                                     lambda: lgc_manager.get_best_fit_functions(dataFrame_train, dataFrame_ideal), repeat)
+        time_stage(stages, 'calculate_max_deviation', lambda: [
+            lgc_manager.calculate_max_deviation(dataFrame_train.iloc[:, [0, column]], dataFrame_ideal.iloc[:, [0, ideal_id]])
+            for column, ideal_id in enumerate(ideal_for_train, start=1)], repeat)
+        pd_func_max_div = lgc_manager.fit_functions(dataFrame_train, dataFrame_ideal)
+
+        # Classification
+        csv_test = db_manager.csv_2DArray(test_path)
+        deviations, func_ids = time_stage(stages, 'classify_batch', lambda: lgc_manager.classify_batch(
+            csv_test.iloc[:, [0, 1]], dataFrame_ideal, pd_func_max_div), repeat)
+
+        # Result writes
+        time_stage(stages, 'testDB_add_records', lambda: db_manager.testDB_add_records(
+            csv_test.iloc[:, 0].values, csv_test.iloc[:, 1].values, deviations, func_ids))
+
+        # Plotting
+        if plot:
+            dataFrame_test = db_manager.load_table('test_db')
+            v_manager = v_mgr.VisualManger(dataFrame_train, dataFrame_ideal, dataFrame_test)
+            colors = [plt.cm.tab10(i % 10) for i in range(len(pd_func_max_div))]
+            colors = [matplotlib.colors.to_hex(color) for color in colors]
+            # Rendered headless into a file, so the stage measures the real drawing
+            plot_path = os.path.join(directory, 'benchmark.png')
+            time_stage(stages, 'visualize_data_and_deviations',
+                       lambda: v_manager.visualize_data_and_deviations(pd_func_max_div, colors, output_path=plot_path))
+
+    return stages
+
+def git_commit():
+    '''
+    Get the current commit of the repository
+
+    :return: commit hash or None outside of a git repository
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, current, threshold):
+    '''
+    Print the change of every stage against a baseline result
+
+    :param baseline: stored result of an earlier run
+    :param current: result of this run
+    :param threshold: relative slow down which counts as regression (0.1 = 10 %)
+    :return: names of the regressed stages
+    '''
+    if baseline['parameters'] != current['parameters']:
+        print("Warning: baseline was run with other parameters")
+
+    regressions = []
+    print(f"\nCompared to {baseline.get('commit')}:")
+    for name, seconds in current['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        ratio = seconds / max(baseline['stages'][name], 1e-12)
+        marker = ''
+        if ratio > 1 + threshold:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<28}{baseline['stages'][name]:>10.4f} s -> {seconds:>10.4f} s  ({ratio:.2f}x){marker}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every pipeline stage on synthetic data')
+    parser.add_argument('--samples', type=int, default=400, help='amount of x samples')
+    parser.add_argument('--ideal', type=int, default=DB_IDEAL_FUNCTIONS, help='amount of ideal functions')
+    parser.add_argument('--train', type=int, default=DB_TRAIN_FUNCTIONS, help='amount of training functions')
+    parser.add_argument('--test', type=int, default=100, help='amount of test points')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of the read only stages')
+    parser.add_argument('--no-plot', action='store_true', help='skip the plotting stage')
+    parser.add_argument('--output', help='json file to store the result in')
+    parser.add_argument('--compare', help='json file of an earlier result to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slow down reported as regression')
+    args = parser.parse_args()
+
+    parameters = {'samples': args.samples, 'ideal': args.ideal, 'train': args.train, 'test': args.test}
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': parameters,
+        'stages': run(args.samples, args.ideal, args.train, args.test, args.repeat, not args.no_plot),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), result, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
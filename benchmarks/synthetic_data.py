@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+
+def generate_datasets(directory, n_samples=400, n_ideal=50, n_train=4, n_test=100, noise=0.3, seed=0):
+    '''
+    Write a synthetic train.csv, ideal.csv and test.csv in the layout of the files in ./data
+
+    :param directory: directory to write the csv files to
+    :param n_samples: amount of x samples of the train and ideal functions
+    :param n_ideal: amount of ideal functions
+    :param n_train: amount of training functions, each one is a noisy ideal function
+    :param n_test: amount of test points
+    :param noise: standard deviation of the noise added to train and test data
+    :param seed: seed of the random generator
+    :return: paths of the train, ideal and test csv file
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    # Ideal functions: a * sin(b * x) + c * x + d
+    x = np.round(np.linspace(-20, 20, n_samples), 6)
+    a, b, c, d = (rng.uniform(-5, 5, n_ideal) for _ in range(4))
+    ideal = a * np.sin(np.outer(x, b)) + np.outer(x, c) + d
+
+    # Training functions: noisy copies of randomly chosen ideal functions
+    chosen = rng.choice(n_ideal, size=n_train, replace=n_train > n_ideal)
+    train = ideal[:, chosen] + rng.normal(0, noise, (n_samples, n_train))
+
+    # Test points: on the x grid, close to a chosen function or anywhere
+    test_rows = rng.integers(0, n_samples, n_test)
+    test_funcs = rng.choice(chosen, size=n_test)
+    test_y = ideal[test_rows, test_funcs] + rng.normal(0, noise, n_test)
+    outliers = rng.random(n_test) < 0.3
+    test_y[outliers] = rng.uniform(-50, 50, outliers.sum())
+
+    paths = tuple(os.path.join(directory, name) for name in ('train.csv', 'ideal.csv', 'test.csv'))
+    pd.DataFrame(np.column_stack([x, train]), columns=['x'] + [f'y{i}' for i in range(1, n_train + 1)]).to_csv(paths[0], index=False)
+    pd.DataFrame(np.column_stack([x, ideal]), columns=['x'] + [f'y{i}' for i in range(1, n_ideal + 1)]).to_csv(paths[1], index=False)
+    pd.DataFrame({'x': x[test_rows], 'y': test_y}).to_csv(paths[2], index=False)
+    return paths
@@ -1,68 +1,154 @@
-import src.sql_manager as sql_mgr
-import src.logic_manager as lgc_mgr
-import src.visual_manager as v_mgr
-import pandas as pd
-import numpy as np
+import argparse
+import contextlib
+import time
+import sys
+import os
 
-def main():
-    # -----------------------------------DATABSE----------------------------------- #
+# The modules of src are imported inside the commands, so every command only loads what it needs
+
+def classify_test_stream(db_manager, lgc_manager, dataFrame_ideal, pd_func_max_div, directory, chunk_size=100000, workers=1, ideal_snapshot=None):
+    '''
+    Classify the test csv chunk by chunk against the fitted functions, every chunk is written into
+    the test table before the next one is read, so the memory usage does not grow with the file size
+
+    :param db_manager: database manager to write the results with
+    :param lgc_manager: logic manager to classify with
+    :param dataFrame_ideal: all ideal function
+    :param pd_func_max_div: array with (choosen function, max deviation)
+    :param directory: directory of test csv file
+    :param chunk_size: amount of test rows per chunk
+    :param workers: amount of worker processes per chunk, 1 classifies in this process
+    :param ideal_snapshot: path of the .npy snapshot of dataFrame_ideal shared with the workers
+    :return: amount of classified test rows
+    '''
+    rows_done = 0
+    start_time = time.perf_counter()
+
+    # Worker processes are started once and used for all chunks
+    pool = lgc_manager.classify_pool(dataFrame_ideal, pd_func_max_div, workers, ideal_snapshot) if workers > 1 else contextlib.nullcontext()
+
+    with pool as executor, db_manager.create_test_writer(batch_size=chunk_size) as test_writer:
+        for csv_test in db_manager.csv_chunks(directory, chunk_size):
+            # Find the best function and its deviation for all test coordinates of the chunk
+            deviations, func_ids = lgc_manager.classify_parallel(csv_test.iloc[:, [0, 1]], dataFrame_ideal, pd_func_max_div,
+                                                                 workers=workers, shard_size=max(1, chunk_size // workers), executor=executor)
+
+            # Import results into the database before reading the next chunk
+            test_writer.add(csv_test.iloc[:, 0].values, csv_test.iloc[:, 1].values, deviations, func_ids)
+            test_writer.flush()
+
+            # Report progress
+            rows_done += len(csv_test)
+            elapsed = time.perf_counter() - start_time
+            print(f"Classified {rows_done} test rows ({rows_done / max(elapsed, 1e-9):.0f} rows/s)")
+
+    return rows_done
 
-    # Create Database
-    db_manager = sql_mgr.DatabaseManager("dataBase.db")
-    db_manager.createDatabase()
+def import_data(args):
+    '''
+    Create the database and import the ideal and train CSV
 
-    # Import ideal CSV into database
-    db_manager.import_idealCSV("./data/ideal.csv")
+    :param args: parsed command line arguments
+    :return: database manager
+    '''
+    import src.sql_manager as sql_mgr
 
-    # Import train CSV into database
-    db_manager.import_trainCSV("./data/train.csv")
+    # Create Database, with pragmas tuned for the bulk phases
+    if args.storage == 'sqlite':
+        db_manager = sql_mgr.DatabaseManager(args.db, pragmas=sql_mgr.TUNED_PRAGMAS)
+    else:
+        # Tables as Parquet or Arrow files next to the database
+        import src.columnar_manager as col_mgr
+        db_manager = col_mgr.ColumnarManager(args.db, storage_format=args.storage, compact=args.compact, pragmas=sql_mgr.TUNED_PRAGMAS)
 
-    # Load (just created) train and ideal table
-    dataFrame_ideal = db_manager.load_table("ideal_db")
-    dataFrame_train = db_manager.load_table("train_db")
+    # One connection for all database steps
+    with db_manager.session():
+        db_manager.createDatabase()
 
-    # Load test CSV into pandas data frame
-    csv_test = db_manager.csv_2DArray("./data/test.csv")
+        # Import ideal and train CSV into database, shipped Parquet/Arrow tables are used without their CSV
+        for directory, import_csv in ((args.ideal, db_manager.import_idealCSV), (args.train, db_manager.import_trainCSV)):
+            if args.storage != 'sqlite' and not os.path.exists(directory):
+                print(f"Skipped import of {directory}, the file does not exist, the stored {args.storage} table is used")
+            else:
+                import_csv(directory)
+
+    return db_manager
+
+def fit(args):
+    '''
+    Import the data and find the best fitting functions with their max deviations
+
+    :param args: parsed command line arguments
+    :return: database manager, logic manager, train data frame, ideal data frame and (choosen function, max deviation) array
+    '''
+    import numpy as np
+    import src.logic_manager as lgc_mgr
+
+    # Ideal data in float32 in compact mode
+    dtype = np.float32 if args.compact else np.float64
+
+    # -----------------------------------DATABSE----------------------------------- #
+    db_manager = import_data(args)
+
+    # Load (just created) train table and the ideal table, from the memory mapped snapshot of the csv for sqlite
+    with db_manager.session():
+        if args.storage == 'sqlite':
+            dataFrame_ideal = db_manager.load_ideal_snapshot(args.ideal, dtype=dtype)
+        else:
+            dataFrame_ideal = db_manager.load_table("ideal_db")
+        dataFrame_train = db_manager.load_table("train_db")
 
 
     # -----------------------------------LOGIC----------------------------------- #
     # Create logic manager
-    lgc_manager = lgc_mgr.LogicManager()
+    lgc_manager = lgc_mgr.LogicManager(dtype=dtype)
+
+    # Find the best fitting functions and their max deviations, memoized in the database
+    pd_func_max_div = lgc_manager.fit_functions(dataFrame_train, dataFrame_ideal, fit_cache=db_manager)
 
-    # Find the four best fitting functions
-    # Function 1
-    ideal_for_y1 = lgc_manager.get_best_fit_function(dataFrame_train.iloc[:,[0,1]], dataFrame_ideal)
-    max_diviation_y1 = lgc_manager.calculate_max_deviation(dataFrame_train.iloc[:, [0,1]], dataFrame_ideal.iloc[:, [0,ideal_for_y1]])
+    return db_manager, lgc_manager, dataFrame_train, dataFrame_ideal, pd_func_max_div
 
-    # Function 2
-    ideal_for_y2 = lgc_manager.get_best_fit_function(dataFrame_train.iloc[:,[0,2]], dataFrame_ideal)
-    max_diviation_y2 = lgc_manager.calculate_max_deviation(dataFrame_train.iloc[:, [0,2]], dataFrame_ideal.iloc[:, [0, ideal_for_y2]])
+def classify(args):
+    '''
+    Fit and classify the test CSV into the test table, skipped if neither changed since the last run
 
-    # Function 3
-    ideal_for_y3 = lgc_manager.get_best_fit_function(dataFrame_train.iloc[:,[0,3]], dataFrame_ideal)
-    max_diviation_y3 = lgc_manager.calculate_max_deviation(dataFrame_train.iloc[:, [0,3]], dataFrame_ideal.iloc[:, [0, ideal_for_y3]])
+    :param args: parsed command line arguments
+    :return: result of fit
+    '''
+    fitted = fit(args)
+    db_manager, lgc_manager, dataFrame_train, dataFrame_ideal, pd_func_max_div = fitted
 
-    # Function 4
-    ideal_for_y4 = lgc_manager.get_best_fit_function(dataFrame_train.iloc[:,[0,4]], dataFrame_ideal)
-    max_diviation_y4 = lgc_manager.calculate_max_deviation(dataFrame_train.iloc[:, [0,4]], dataFrame_ideal.iloc[:, [0, ideal_for_y4]])
+    # One connection for all database steps of the classification
+    with db_manager.session():
+        # Only classify the test CSV again if it or the fitted functions changed
+        test_source = os.path.abspath(args.test)
+        test_hash = db_manager.fingerprint_file(test_source, extra=pd_func_max_div.to_json())
+        test_fingerprint = db_manager.get_import_fingerprint(test_source)
+        if test_fingerprint is not None and test_fingerprint['hash'] == test_hash:
+            print(f"Skipped classification of {args.test}, test data and fitted functions are unchanged")
+        else:
+            # Replace the outdated results
+            db_manager.clear_table("test_db")
 
-    # Convert to usabel pandas data frame
-    pd_func_max_div = pd.DataFrame([[ideal_for_y1, max_diviation_y1 * np.sqrt(2)],  # "* np.sqrt(2)" for the max diviation of the test data
-                                    [ideal_for_y2, max_diviation_y2 * np.sqrt(2)],  # -- 
-                                    [ideal_for_y3, max_diviation_y3 * np.sqrt(2)],  # -- 
-                                    [ideal_for_y4, max_diviation_y4 * np.sqrt(2)]], # -- 
-                                    columns=['func_id', 'max_div'])
+            # Classify the test CSV chunk wise and import the results into the database
+            # Workers share the snapshot of the ideal csv, for Parquet/Arrow tables a temporary one is written
+            ideal_snapshot = db_manager.ideal_snapshot_path(args.ideal, dtype=lgc_manager.dtype) if args.workers > 1 and args.storage == 'sqlite' else None
+            rows_done = classify_test_stream(db_manager, lgc_manager, dataFrame_ideal, pd_func_max_div, test_source,
+                                             args.chunk_size, args.workers, ideal_snapshot)
+            db_manager.record_import_fingerprint(test_source, "test_db", test_hash, rows_done, "x,y")
 
-    for index, row in csv_test.iterrows():
-        x_value = csv_test.iloc[index, 0] 
-        y_value = csv_test.iloc[index, 1] 
+    return fitted
 
-        # Find the beste function and its deviation for the test table
-        deviation_and_funcID = lgc_manager.find_best_function_test(x_value, y_value, dataFrame_ideal, pd_func_max_div)
+def plot(args, fitted=None):
+    '''
+    Visualise the data and the classified test table
 
-        # Import result into the database  
-        db_manager.testDB_add_record(x_value, y_value, deviation_and_funcID[0], deviation_and_funcID[1]);        
+    :param args: parsed command line arguments
+    :param fitted: result of fit, fitted (from the memoized result) if None
+    '''
+    import src.visual_manager as v_mgr
 
+    db_manager, lgc_manager, dataFrame_train, dataFrame_ideal, pd_func_max_div = fitted or fit(args)
 
     # -----------------------------------VISUALISATION----------------------------------- #
     # Load the test database for visualisation
@@ -75,10 +161,101 @@ def main():
                        '#63bc46']
 
     # Create VisualManager
-    v_manager = v_mgr.VisualManger(dataFrame_train, dataFrame_ideal, dataFrame_test)
-    # Start visualisation procedure
-    v_manager.visualize_data_and_deviations(pd_func_max_div , function_colors)
+    v_manager = v_mgr.VisualManger(dataFrame_train, dataFrame_ideal, dataFrame_test, large_data=args.large_data)
+    # Start visualisation procedure, rendered headless into a file if an output is set
+    v_manager.visualize_data_and_deviations(pd_func_max_div , function_colors, args.output)
+
+def run(args):
+    '''
+    Whole pipeline: import, fit, classify and plot
+
+    :param args: parsed command line arguments
+    '''
+    plot(args, classify(args))
+
+def serve(args):
+    '''
+    Fit once and keep classifying test coordinates sent to a local socket
+
+    :param args: parsed command line arguments
+    '''
+    import asyncio
+    import src.service_manager as svc_mgr
+
+    # Fit once, the service keeps the result in memory
+    db_manager, lgc_manager, dataFrame_train, dataFrame_ideal, pd_func_max_div = fit(args)
+
+    service = svc_mgr.ServiceManager(db_manager, lgc_manager, dataFrame_ideal, pd_func_max_div)
+    asyncio.run(service.serve(args.host, args.port))
+
+def parse_arguments(argv):
+    '''
+    Parse the command line, without a command the whole pipeline is run
+
+    :param argv: command line arguments without the program name
+    :return: parsed arguments
+    '''
+    # Options of every command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default='dataBase.db', help='path of the database')
+    common.add_argument('--ideal', default='./data/ideal.csv', help='ideal CSV')
+    common.add_argument('--train', default='./data/train.csv', help='train CSV')
+    common.add_argument('--test', default='./data/test.csv', help='test CSV')
+    common.add_argument('--storage', choices=['sqlite', 'parquet', 'arrow'], default='sqlite', help='storage of the train, ideal and test tables')
+    common.add_argument('--compact', action='store_true', help='process the ideal and test data in float32')
+    common.add_argument('--metrics', default=os.environ.get('PIPELINE_METRICS'), help='export stage metrics to this file (.json or .prom)')
+    common.add_argument('--trace-memory', action='store_true', help='trace the peak memory of every stage with tracemalloc (slow)')
+
+    classify_options = argparse.ArgumentParser(add_help=False)
+    classify_options.add_argument('--chunk-size', type=int, default=100000, help='test rows classified per chunk')
+    classify_options.add_argument('--workers', type=int, default=1, help='worker processes for the classification')
+
+    plot_options = argparse.ArgumentParser(add_help=False)
+    plot_options.add_argument('--output', default=os.environ.get('PIPELINE_PLOT'), help='render headless into this file (png, svg, pdf) instead of a window')
+    plot_options.add_argument('--large-data', action='store_true', help='draw points as density raster and decimate curves')
+
+    parser = argparse.ArgumentParser(description='Find ideal functions for training data and classify test data')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('import', parents=[common], help='import the ideal and train CSV').set_defaults(function=import_data)
+    commands.add_parser('fit', parents=[common], help='fit the ideal functions').set_defaults(function=fit)
+    commands.add_parser('classify', parents=[common, classify_options], help='classify the test CSV').set_defaults(function=classify)
+    commands.add_parser('plot', parents=[common, plot_options], help='visualise the classified data').set_defaults(function=plot)
+    commands.add_parser('run', parents=[common, classify_options, plot_options], help='whole pipeline (default)').set_defaults(function=run)
+    serve_parser = commands.add_parser('serve', parents=[common], help='classify test coordinates sent to a local socket')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    serve_parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    serve_parser.set_defaults(function=serve)
+
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['run', *argv]
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+
+    # Record the stage metrics if an export file is set
+    metrics_manager = None
+    if args.metrics:
+        import src.metrics_manager as mtr_mgr
+        metrics_manager = mtr_mgr.MetricsManager(trace_memory=args.trace_memory)
+        metrics_manager.enable()
+
+    try:
+        result = args.function(args)
+        if args.command == 'fit':
+            print(result[4].to_string(index=False))
+
+            # Report how far the compact mode is off
+            if args.compact:
+                db_manager, lgc_manager, dataFrame_train, dataFrame_ideal, pd_func_max_div = result
+                with db_manager.session():
+                    dataFrame_ideal = db_manager.load_ideal_snapshot(args.ideal)
+                print(f"Difference to float64: {lgc_manager.precision_report(dataFrame_train, dataFrame_ideal)}")
+    finally:
+        if metrics_manager is not None:
+            metrics_manager.disable()
+            metrics_manager.export(args.metrics)
 
 if __name__ == "__main__":
     # Setting up that this file will be started first with its main
-    main()
\ No newline at end of file
+    main()
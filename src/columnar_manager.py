@@ -0,0 +1,450 @@
+import glob
+import os
+import time
+import uuid
+import pandas as pd
+import numpy as np
+from src.sql_manager import DatabaseManager, TABLE_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    # Optional dependency, only needed for the columnar storage
+    pa = None
+
+# Tables stored as float32 in compact mode
+COMPACT_TABLES = ('ideal_db', 'test_db', 'service_db')
+
+# Appended parts of a process are merged once there are this many, until the merged part reaches the max rows
+COMPACT_PARTS = 16
+COMPACT_MAX_ROWS = 1000000
+
+# File extension and pyarrow dataset format of every storage format
+STORAGE_FORMATS = {
+    'parquet': ('.parquet', 'parquet'),
+    'arrow': ('.arrow', 'ipc'),
+}
+
+class ColumnarManager(DatabaseManager):
+    # Keyed tables are rewritten on every import, so a csv is imported at once
+    IMPORT_CHUNK_ROWS = None
+
+    def __init__(self, db_path, storage_dir=None, storage_format='parquet', compression='zstd', compact=False, pragmas=None):
+        '''
+        Stores the train, ideal and test tables as compressed Parquet or Arrow IPC files instead of sqlite rows,
+        with the same interface as DatabaseManager. Every table is a directory of part files, which can be
+        copied to other machines as is. The import fingerprints and memoized fit results stay in the sqlite database
+
+        :param db_path: path to the sqlite database of the fingerprints and fit results
+        :param storage_dir: directory of the table files, 'tables' ('tables_float32' if compact) next to the database if None
+        :param storage_format: 'parquet' or 'arrow' (Arrow IPC)
+        :param compression: compression codec of the files (e.g. 'zstd', 'lz4' or 'uncompressed')
+        :param compact: if True the ideal and test tables are stored and loaded as float32
+        :param pragmas: dict of sqlite pragmas set on every new connection, sqlite defaults if None
+        '''
+        if pa is None:
+            raise ImportError("The columnar storage needs pyarrow, install it with: pip install pyarrow")
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format {storage_format}, choose one of {', '.join(STORAGE_FORMATS)}")
+
+        super().__init__(db_path, pragmas)
+        if storage_dir is None:
+            storage_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'tables_float32' if compact else 'tables')
+        self.storage_dir = storage_dir
+        self.storage_format = storage_format
+        self.compression = compression
+        self.compact = compact
+
+        # Appended parts written by this manager and not merged yet, as (path, rows) per table
+        self._appended_parts = {}
+
+    def table_path(self, table_name):
+        '''
+        Get the directory of the part files of a table
+
+        :param table_name: name of the table
+        :return: directory of the table
+        '''
+        if table_name not in TABLE_COLUMNS:
+            raise ValueError(f"Table {table_name} does not exist")
+        return os.path.join(self.storage_dir, table_name)
+
+    def _part_files(self, table_name):
+        '''
+        Get the part files of a table in write order
+
+        :param table_name: name of the table
+        :return: list of file paths
+        '''
+        extension = STORAGE_FORMATS[self.storage_format][0]
+        return sorted(glob.glob(os.path.join(self.table_path(table_name), f'part-*{extension}')))
+
+    def _storage_source(self, source):
+        '''
+        Name of a source inside the import fingerprints of this storage, so the sqlite tables and
+        other storages sharing the database keep their own fingerprints
+
+        :param source: name of the source (e.g. path of the csv file)
+        :return: source prefixed with the storage directory and format
+        '''
+        return f'{os.path.abspath(self.storage_dir)}|{self.storage_format}|{source}'
+
+    def get_import_fingerprint(self, source):
+        '''
+        Get the recorded fingerprint of a source imported into this storage
+
+        :param source: name of the source (e.g. path of the csv file)
+        :return: dict with table, hash, row count and schema or None if never imported
+        '''
+        return super().get_import_fingerprint(self._storage_source(source))
+
+    def record_import_fingerprint(self, source, table_name, file_hash, row_count, schema, connection=None):
+        '''
+        Record the fingerprint of a source imported into this storage
+
+        :param source: name of the source (e.g. path of the csv file)
+        :param table_name: table the source was imported into
+        :param file_hash: content hash of the source
+        :param row_count: amount of rows of the source
+        :param schema: column names of the source
+        :param connection: open connection to record inside its transaction, otherwise an own transaction is used
+        :return: BOOL if successfull
+        '''
+        return super().record_import_fingerprint(self._storage_source(source), table_name, file_hash, row_count, schema, connection)
+
+    def column_dtype(self, table_name):
+        '''
+        Get the precision a table is stored and loaded in
+
+        :param table_name: name of the table
+        :return: np.float32 for the ideal and test tables in compact mode, np.float64 otherwise
+        '''
+        return np.float32 if self.compact and table_name in COMPACT_TABLES else np.float64
+
+    def _dataset(self, table_name, part_files=None):
+        '''
+        Open the part files of a table as one dataset, nothing is read yet
+
+        :param table_name: name of the table
+        :param part_files: files to open, all part files if None
+        :return: pyarrow dataset with one float column per table column
+        '''
+        column_type = pa.from_numpy_dtype(self.column_dtype(table_name))
+        schema = pa.schema([(name, column_type) for name in TABLE_COLUMNS[table_name]])
+        part_files = self._part_files(table_name) if part_files is None else part_files
+        return ds.dataset(part_files, schema=schema, format=STORAGE_FORMATS[self.storage_format][1])
+
+    def _read_frame(self, table_name, columns, condition, chunk_size):
+        '''
+        Read only the selected columns and the rows matching the condition of a table
+
+        :param table_name: name of the table
+        :param columns: names of the columns to load, all columns if None
+        :param condition: pyarrow filter expression or None
+        :param chunk_size: amount of rows per scanned batch
+        :return: panda data frame with float columns in the precision of the table, null becomes NaN
+        '''
+        column_names = list(TABLE_COLUMNS[table_name]) if columns is None else list(columns)
+        for name in column_names:
+            if name not in TABLE_COLUMNS[table_name]:
+                raise ValueError(f"Column {name} does not exist in {table_name}")
+
+        table = self._dataset(table_name).to_table(columns=column_names, filter=condition, batch_size=chunk_size)
+        dtype = self.column_dtype(table_name)
+        return pd.DataFrame({name: table.column(name).to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+                             for name in column_names})
+
+    def _write_part(self, table_name, data_frame:pd.DataFrame):
+        '''
+        Write a data frame as new part file of a table
+
+        :param table_name: name of the table
+        :param data_frame: data frame with the columns of the table, NaN is stored as null
+        :return: path of the part file
+        '''
+        directory = self.table_path(table_name)
+        os.makedirs(directory, exist_ok=True)
+
+        dtype = self.column_dtype(table_name)
+        table = pa.table({name: pa.array(data_frame[name].to_numpy(dtype=dtype), from_pandas=True)
+                          for name in TABLE_COLUMNS[table_name]})
+
+        # Part files are named by write time, the random suffix keeps parts of concurrent processes apart
+        part_name = f'part-{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}{STORAGE_FORMATS[self.storage_format][0]}'
+        part_path = os.path.join(directory, part_name)
+
+        # Write to a temporary file first, so readers never open a half written part
+        temp_path = f'{part_path}.{os.getpid()}.tmp'
+        if self.storage_format == 'parquet':
+            pq.write_table(table, temp_path, compression=self.compression)
+        else:
+            feather.write_feather(table, temp_path, compression=self.compression)
+        os.replace(temp_path, part_path)
+        return part_path
+
+    def _append_part(self, table_name, data_frame:pd.DataFrame):
+        '''
+        Write a data frame as new part file of a table and merge the small parts this manager appended,
+        so frequent small writes (e.g. one per service micro batch) do not leave one file each
+
+        :param table_name: name of the table
+        :param data_frame: data frame with the columns of the table
+        '''
+        parts = self._appended_parts.setdefault(table_name, [])
+        parts.append((self._write_part(table_name, data_frame), len(data_frame)))
+        if len(parts) < COMPACT_PARTS:
+            return
+
+        try:
+            # Only parts of this manager are merged, other processes never touch them
+            paths = [path for path, _ in parts]
+            merged = self._dataset(table_name, paths).to_table().to_pandas()
+            merged_path = self._write_part(table_name, merged)
+            self._remove_parts(table_name, paths)
+        except FileNotFoundError:
+            # The table was cleared meanwhile
+            self._appended_parts[table_name] = []
+            return
+
+        # A merged part keeps collecting appends until it is large enough
+        self._appended_parts[table_name] = [(merged_path, len(merged))] if len(merged) < COMPACT_MAX_ROWS else []
+
+    def _remove_parts(self, table_name, part_files=None):
+        '''
+        Delete part files of a table
+
+        :param table_name: name of the table
+        :param part_files: files to delete, all part files if None
+        '''
+        for path in self._part_files(table_name) if part_files is None else part_files:
+            os.remove(path)
+
+    def load_table(self, table_name, columns=None, x_range=None, chunk_size=50000):
+        '''
+        Loads table into a pandas data frame. Only the requested columns are read from the files
+        and the x range filter is pushed down to the row groups
+
+        :param table_name: name of the table to load
+        :param columns: names of the columns to load, all columns if None
+        :param x_range: (min, max) of the X column to load, a bound can be None
+        :param chunk_size: amount of rows per scanned batch
+        :return: panda data frame of table
+        '''
+        condition = None
+        if x_range is not None:
+            x_field = ds.field(TABLE_COLUMNS[table_name][0])
+            if x_range[0] is not None:
+                condition = x_field >= float(x_range[0])
+            if x_range[1] is not None:
+                upper = x_field <= float(x_range[1])
+                condition = upper if condition is None else condition & upper
+
+        return self._read_frame(table_name, columns, condition, chunk_size)
+
+    def query_test_results(self, func_id=None, x_range=None, max_deviation=None, matched=None, columns=None, chunk_size=50000):
+        '''
+        Load only the classification results matching all given filters, the filters are pushed
+        down to the row groups of the test files
+
+        :param func_id: No. of ideal func (or list of them) to load
+        :param x_range: (min, max) of X (test func) to load, a bound can be None
+        :param max_deviation: load only results with Delta Y (test func) <= max_deviation
+        :param matched: True for results with a matched function only, False for unmatched only
+        :param columns: names of the columns to load, all columns if None
+        :param chunk_size: amount of rows per scanned batch
+        :return: panda data frame of the matching results
+        '''
+        # Creation of the filter expression, null never matches a comparison like in SQL
+        conditions = []
+        if func_id is not None:
+            func_ids = [float(value) for value in np.atleast_1d(func_id)]
+            conditions.append(ds.field('No. of ideal func').isin(func_ids))
+        if x_range is not None:
+            if x_range[0] is not None:
+                conditions.append(ds.field('X (test func)') >= float(x_range[0]))
+            if x_range[1] is not None:
+                conditions.append(ds.field('X (test func)') <= float(x_range[1]))
+        if max_deviation is not None:
+            conditions.append(ds.field('Delta Y (test func)') <= float(max_deviation))
+        if matched is not None:
+            conditions.append(ds.field('No. of ideal func').is_valid() if matched else ds.field('No. of ideal func').is_null())
+
+        condition = None
+        for expression in conditions:
+            condition = expression if condition is None else condition & expression
+
+        return self._read_frame('test_db', columns, condition, chunk_size)
+
+    def clear_table(self, table_name):
+        '''
+        Delete all records of a table together with the import fingerprints of the table
+
+        :param table_name: name of the table to clear
+        :return: BOOL if successfull
+        '''
+        try:
+            self._appended_parts.pop(table_name, None)
+            self._remove_parts(table_name)
+        except Exception as e:
+            print(f"Error while DELETE operation in {table_name}: {e}")
+            return False
+
+        return super().clear_table(table_name)
+
+    def bulk_import_dataframe(self, table_name, data_frame:pd.DataFrame, chunk_size=50000, upsert=False, fingerprint=None, raise_errors=False):
+        '''
+        Import a whole data frame into a table. The data frame columns are matched by position to the
+        table columns. Tables with an X primary key are merged with the stored rows and rewritten as one
+        part sorted by X, rows with a duplicate or invalid X are skipped and reported in one summary.
+        Other tables get a new part file
+
+        :param table_name: name of the table to import into
+        :param data_frame: data frame with one column per table column
+        :param chunk_size: unused, for the interface of DatabaseManager
+        :param upsert: if True rows with an existing X replace the stored values if they differ, instead of being skipped
+        :param fingerprint: dict with source, hash, row_count and schema recorded after the write
+        :param raise_errors: if True a failed import is raised, instead of returning 0
+        :return: size of successfull added (or updated) records
+        '''
+        columns = TABLE_COLUMNS[table_name]
+        if len(data_frame.columns) != len(columns):
+            raise ValueError(f"Expected {len(columns)} columns for {table_name}, got {len(data_frame.columns)}")
+        new_rows = pd.DataFrame(data_frame.to_numpy(dtype=self.column_dtype(table_name)), columns=columns)
+
+        try:
+            if table_name in ('test_db', 'service_db'):
+                # Results have no key, they are appended
+                counter = len(new_rows)
+                if counter > 0:
+                    self._append_part(table_name, new_rows)
+            else:
+                counter, merged = self._merge_rows(table_name, new_rows, upsert)
+                if counter > 0:
+                    # Replace the old parts only after the merged part is written
+                    old_parts = self._part_files(table_name)
+                    self._write_part(table_name, merged)
+                    self._remove_parts(table_name, old_parts)
+
+            # Record the fingerprint of the imported source
+            if fingerprint is not None:
+                self.record_import_fingerprint(fingerprint['source'], table_name, fingerprint['hash'],
+                                               fingerprint['row_count'], fingerprint['schema'])
+
+        except Exception as e:
+            print(f"Error while bulk INSERT operation in {table_name}: {e}")
+            if raise_errors:
+                raise
+            return 0
+
+        # Report all rejected or unchanged rows in one summary
+        skipped = len(data_frame) - counter
+        if skipped > 0 and upsert:
+            print(f"Kept {skipped} of {len(data_frame)} unchanged rows while bulk UPSERT operation in {table_name}")
+        elif skipped > 0:
+            print(f"Skipped {skipped} of {len(data_frame)} rows while bulk INSERT operation in {table_name} (duplicate or invalid X primary key)")
+
+        # Return the amount of records that has been added
+        return counter
+
+    def _merge_rows(self, table_name, new_rows:pd.DataFrame, upsert):
+        '''
+        Merge new rows into the stored rows of a table with an X primary key
+
+        :param table_name: name of the table
+        :param new_rows: rows to import with the table columns
+        :param upsert: if True rows with an existing X replace the stored values if they differ, otherwise they are skipped
+        :return: amount of added (or updated) rows and the merged data frame sorted by X
+        '''
+        x_column = TABLE_COLUMNS[table_name][0]
+        stored = self.load_table(table_name)
+
+        # Rows without X are invalid, the first row of a duplicate X wins on insert and the last one on upsert
+        new_rows = new_rows[new_rows[x_column].notna()]
+        new_rows = new_rows.drop_duplicates(x_column, keep='last' if upsert else 'first')
+        is_stored = new_rows[x_column].isin(stored[x_column])
+
+        if not upsert:
+            added = new_rows[~is_stored]
+            return len(added), pd.concat([stored, added], ignore_index=True).sort_values(x_column, ignore_index=True)
+
+        # Only count stored rows whose values differ, NaN equals NaN like IS NOT in SQL
+        previous = stored.set_index(x_column).loc[new_rows.loc[is_stored, x_column]]
+        current = new_rows[is_stored].set_index(x_column)
+        changed = ~((previous == current) | (previous.isna() & current.isna())).all(axis=1)
+
+        kept = stored[~stored[x_column].isin(new_rows[x_column])]
+        merged = pd.concat([kept, new_rows], ignore_index=True).sort_values(x_column, ignore_index=True)
+        return int((~is_stored).sum() + changed.sum()), merged
+
+    def trainDB_add_record(self, x, y1, y2, y3, y4):
+        '''
+        Add a record to the train table
+
+        :param x: X value
+        :param y1: Y1 (training func) value
+        :param y2: Y2 (training func) value
+        :param y3: Y3 (training func) value
+        :param y4: Y4 (training func) value
+        :return: BOOL if successfull
+        '''
+        return self.bulk_import_dataframe('train_db', pd.DataFrame([[x, y1, y2, y3, y4]])) == 1
+
+    def idealDB_add_record(self, x, y_values):
+        '''
+        Add a record to the ideal table
+
+        :param x: X value
+        :param y_values: list of the 50 Y (ideal func) values
+        :return: BOOL if successfull
+        '''
+        return self.bulk_import_dataframe('ideal_db', pd.DataFrame([[x, *y_values]])) == 1
+
+    def testDB_add_record(self, x_test, y_test, delta_y_test, no_ideal_func):
+        '''
+        Add a record to the test table
+
+        :param x_test: X value
+        :param y_test: Y (test func) value
+        :param delta_y_test: Delta Y (test func) value, None if unmatched
+        :param no_ideal_func: No. of ideal func value, None if unmatched
+        :return: BOOL if successfull
+        '''
+        return self.testDB_add_records([x_test], [y_test], [delta_y_test], [no_ideal_func]) == 1
+
+    def testDB_add_records(self, x_test, y_test, delta_y_test, no_ideal_func, table_name='test_db'):
+        '''
+        Add many records to the test table as one new part file,
+        missing deviations and function numbers (None/NaN) are stored as null
+
+        :param x_test: array of X values
+        :param y_test: array of Y (test func) values
+        :param delta_y_test: array of Delta Y (test func) values
+        :param no_ideal_func: array of No. of ideal func values
+        :param table_name: 'test_db' or 'service_db' (results of the classification service)
+        :return: size of successfull added records
+        '''
+        columns = [pd.Series(values, dtype=float).to_numpy() for values in (x_test, y_test, delta_y_test, no_ideal_func)]
+        if len(columns[0]) == 0:
+            return 0
+        return self.bulk_import_dataframe(table_name, pd.DataFrame(dict(zip(TABLE_COLUMNS[table_name], columns))))
+
+    def createDatabase(self):
+        '''
+        Creates the sqlite tables of the fingerprints and fit results and the table directories, if not already exist
+
+        :return: true if successfull
+        '''
+        if not super().createDatabase():
+            return False
+
+        try:
+            for table_name in TABLE_COLUMNS:
+                os.makedirs(self.table_path(table_name), exist_ok=True)
+            return True
+
+        except Exception as e:
+            print(f"Error while database creation: {e}")
+            return False
@@ -1,10 +1,63 @@
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import cdist
+import os
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+from collections import OrderedDict
+
+# The max deviation of a test coordinate is sqrt(2) times the max deviation of the training data
+TEST_DEVIATION_FACTOR = np.sqrt(2)
+
+# Version of the fitting, part of the memoization key, increase it when the fitting changes
+FIT_VERSION = 2
+
+# Rows per block of the float32 fit, the sums of a block are added up in float64
+COMPACT_BLOCK_ROWS = 4096
+
+# State of a classify_parallel worker process, set once per process by _init_classify_worker
+_worker_state = {}
+
+def _init_classify_worker(ideal_snapshot, ideal_columns, pd_func_max_div):
+    """
+    Open the memory mapped ideal matrix once per worker process, all workers share its pages
+
+    :param ideal_snapshot: path of the .npy snapshot of the ideal matrix
+    :param ideal_columns: column names of the ideal matrix
+    :param pd_func_max_div: array with (choosen function, max deviation)
+    """
+    ideal_matrix = np.load(ideal_snapshot, mmap_mode='r')
+    _worker_state['ideal'] = pd.DataFrame(ideal_matrix, columns=ideal_columns, copy=False)
+    _worker_state['func_max_div'] = pd_func_max_div
+    _worker_state['logic'] = LogicManager(dtype=ideal_matrix.dtype)
+
+def _classify_shard(test_xy):
+    """
+    Classify one shard of test coordinates inside a worker process
+
+    :param test_xy: array of (x, y) test coordinates
+    :return: arrays with the best deviation and the best fitting function
+    """
+    return _worker_state['logic'].classify_batch(test_xy, _worker_state['ideal'], _worker_state['func_max_div'])
 
 class LogicManager:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, dtype=np.float64) -> None:
+        '''
+        Fits and classifies with ideal and test data in the given precision
+
+        :param dtype: np.float64 or np.float32 (compact mode, half the memory and bandwidth, sums and
+                      distances are still reduced in float64, see precision_report)
+        '''
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float64, np.float32):
+            raise ValueError(f"Unsupported precision {self.dtype}, choose float64 or float32")
+
+        # Nearest neighbour index per chosen function and the norms of the ideal functions, valid for _nn_index_source only
+        self._nn_indexes = {}
+        self._nn_index_source = None
+        self._ideal_norms = None
 
     def get_best_fit_function(self, xy_train_func:pd.DataFrame, xy_all_ideal_func:pd.DataFrame):
         '''
@@ -14,65 +67,182 @@ class LogicManager:
         :param xy_all_ideal_func: all possible ideal functions
         :return: index of best fitting function
         '''
+        return int(self.get_best_fit_functions(xy_train_func, xy_all_ideal_func)[0])
+
+    def get_best_fit_functions(self, xy_train_funcs:pd.DataFrame, xy_all_ideal_funcs:pd.DataFrame) -> np.ndarray:
+        '''
+        Find the best fitting ideal function for every train function at once. All sums of squared
+        errors are estimated in one pass with ||t||² - 2·tᵀY + ||Y||², the exact sums are only
+        calculated for the functions within the rounding error of the best estimate
+
+        :param xy_train_funcs: x column followed by k train functions (n x (k+1))
+        :param xy_all_ideal_funcs: x column followed by m possible ideal functions (n x (m+1))
+        :return: array with the column index of the best fitting ideal function for each train function
+        '''
         # Ensure x values match
-        if not np.array_equal(xy_train_func.iloc[:, 0], xy_all_ideal_func.iloc[:, 0]):
+        if not np.array_equal(xy_train_funcs.iloc[:, 0].to_numpy(dtype=self.dtype), xy_all_ideal_funcs.iloc[:, 0].to_numpy(dtype=self.dtype)):
             raise ValueError("X values in training and ideal datasets do not match")
 
-        y_train = xy_train_func.iloc[:, 1].values
-        best_function  = -1
-        smalest_deviation = float('inf')
-        for column in range(1, 51):
-            y_ideal = xy_all_ideal_func.iloc[:, column].values
-            # Least squares calculation
-            deviation = np.sum((y_train - y_ideal) ** 2)  
+        y_train = xy_train_funcs.iloc[:, 1:].to_numpy(dtype=self.dtype)
+        y_ideal = xy_all_ideal_funcs.iloc[:, 1:].to_numpy(dtype=self.dtype)
+
+        # In float32 the expansion below cancels too much, the residuals are summed block wise instead
+        if self.dtype == np.float32:
+            fitter = IncrementalFitter(y_train.shape[1], y_ideal.shape[1], dtype=self.dtype)
+            for start in range(0, len(y_train), COMPACT_BLOCK_ROWS):
+                fitter.add_rows(y_train[start:start + COMPACT_BLOCK_ROWS], y_ideal[start:start + COMPACT_BLOCK_ROWS])
+            return fitter.get_best_fit_functions()
+
+        # Reuse the norms precomputed by get_ideal_norms for the same ideal data
+        if xy_all_ideal_funcs is self._nn_index_source and self._ideal_norms is not None:
+            ideal_norms = self._ideal_norms
+        else:
+            ideal_norms = np.einsum('ij,ij->j', y_ideal, y_ideal)
+
+        # Least squares calculation for all (train, ideal) pairs (k x m)
+        train_norms = np.einsum('ij,ij->j', y_train, y_train)
+        deviations = (train_norms[:, np.newaxis]
+                      - 2.0 * (y_train.T @ y_ideal)
+                      + ideal_norms[np.newaxis, :])
+
+        # Functions containing NaN can never be the best fit
+        deviations[np.isnan(deviations)] = np.inf
+
+        # The expansion cancels when the curves are large compared with the gaps between them, so it only
+        # shortlists the functions within its rounding error of the minimum
+        error_bound = 4.0 * len(y_train) * np.finfo(np.float64).eps * (train_norms[:, np.newaxis] + ideal_norms[np.newaxis, :])
+        shortlist = deviations - error_bound <= np.min(deviations + error_bound, axis=1, keepdims=True)
+
+        # The exact sum of squared errors decides between the shortlisted functions
+        best_functions = np.full(len(deviations), -1)
+        for column in range(len(deviations)):
+            candidates = np.flatnonzero(shortlist[column])
+            residuals = y_ideal[:, candidates] - y_train[:, [column]]
+            sse = np.einsum('ij,ij->j', residuals, residuals)
+            sse[np.isnan(sse)] = np.inf
 
-            # Update with better function if smaller diviations has been found
-            if deviation < smalest_deviation:
-                smalest_deviation = deviation
-                best_function = column
+            # No function found if all are inf
+            if len(candidates) > 0 and not np.all(np.isinf(sse)):
+                best_functions[column] = candidates[np.argmin(sse)] + 1
+        return best_functions
 
-        return best_function
+    def fit_functions(self, dataFrame_train:pd.DataFrame, dataFrame_ideal:pd.DataFrame, fit_cache=None) -> pd.DataFrame:
+        '''
+        Find the best fitting ideal function for every train function and the max deviation
+        a test coordinate may have to it
+
+        :param dataFrame_train: x column followed by the train functions
+        :param dataFrame_ideal: x column followed by all possible ideal functions
+        :param fit_cache: store with get_fit_result(key) and put_fit_result(key, result) (e.g. DatabaseManager),
+                          on a hit the stored result is returned without fitting
+        :return: array with (choosen function, max deviation)
+        '''
+        # Return the memoized result of the same input
+        if fit_cache is not None:
+            key = self.fit_fingerprint(dataFrame_train, dataFrame_ideal)
+            cached = fit_cache.get_fit_result(key)
+            if cached is not None:
+                stored = json.loads(cached)
+                return pd.DataFrame({'func_id': np.array(stored['func_id'], dtype=np.int64),
+                                     'max_div': np.array(stored['max_div'], dtype=np.float64)})
+
+        # Find the best fitting function for every training function at once
+        ideal_for_train = self.get_best_fit_functions(dataFrame_train, dataFrame_ideal)
+
+        # Calculate the max deviation of each training function to its ideal function
+        func_max_div = []
+        for column, ideal_id in enumerate(ideal_for_train, start=1):
+            max_diviation = self.calculate_max_deviation(dataFrame_train.iloc[:, [0, column]], dataFrame_ideal.iloc[:, [0, ideal_id]])
+            func_max_div.append([int(ideal_id), max_diviation * TEST_DEVIATION_FACTOR])
+
+        # Convert to usabel pandas data frame
+        pd_func_max_div = pd.DataFrame(func_max_div, columns=['func_id', 'max_div'])
+
+        if fit_cache is not None:
+            fit_cache.put_fit_result(key, json.dumps({'func_id': pd_func_max_div['func_id'].tolist(),
+                                                      'max_div': pd_func_max_div['max_div'].tolist()}))
+        return pd_func_max_div
+
+    def fit_fingerprint(self, dataFrame_train:pd.DataFrame, dataFrame_ideal:pd.DataFrame):
+        '''
+        Hash of everything fit_functions depends on: train and ideal data and the fitting parameters
+
+        :param dataFrame_train: x column followed by the train functions
+        :param dataFrame_ideal: x column followed by all possible ideal functions
+        :return: sha256 hex digest
+        '''
+        fit_hash = hashlib.sha256()
+        fit_hash.update(f'{FIT_VERSION}:{TEST_DEVIATION_FACTOR!r}'.encode())
+        if self.dtype != np.float64:
+            fit_hash.update(f':{self.dtype.name}'.encode())
+        for data_frame in (dataFrame_train, dataFrame_ideal):
+            values = np.ascontiguousarray(data_frame.to_numpy(dtype=np.float64))
+            fit_hash.update(f'{values.shape}'.encode())
+            fit_hash.update(memoryview(values).cast('B'))
+        return fit_hash.hexdigest()
 
-    def calculate_max_deviation(self, xy_train: np.array, xy_ideal: np.array) -> float:
+    def calculate_max_deviation(self, xy_train: np.array, xy_ideal: np.array, max_memory_bytes=64 * 1024**2) -> float:
         """
         Calculate the maximum point-wise Euclidean deviation between training data and ideal function.
+        Instead of a dense distance matrix the closest ideal point is looked up in a KD-tree, the
+        training points are queried in blocks so the query memory stays below max_memory_bytes
 
         :param xy_train: Array of (x, y) coordinates of the training data
         :param xy_ideal: Array of (x, y) coordinates of the ideal function
+        :param max_memory_bytes: memory cap for the query blocks (the KD-tree itself needs O(M))
         :return: Maximum deviation
         """
         # Ensure the input arrays are 2D
-        xy_train = np.atleast_2d(xy_train)
-        xy_ideal = np.atleast_2d(xy_ideal)
+        xy_train = np.atleast_2d(np.asarray(xy_train, dtype=np.float64))
+        xy_ideal = np.atleast_2d(np.asarray(xy_ideal, dtype=np.float64))
 
-        # Calculate pairwise distances between all points
-        distances = cdist(xy_train, xy_ideal)
+        # Points with missing values are left out, like in the nearest neighbour indexes of the classification
+        xy_train = xy_train[np.isfinite(xy_train).all(axis=1)]
+        xy_ideal = xy_ideal[np.isfinite(xy_ideal).all(axis=1)]
+        if len(xy_train) == 0 or len(xy_ideal) == 0:
+            return np.nan
+
+        # Build the spatial index over the ideal points
+        from scipy.spatial import cKDTree
+        tree = cKDTree(xy_ideal)
+
+        # Per queried point: coordinates, distance and index
+        block_size = max(1, max_memory_bytes // (xy_train.shape[1] * 8 + 16))
 
         # For each training point, find the minimum distance to any ideal point
-        min_distances = np.min(distances, axis=1)
+        max_distance = -np.inf
+        for start in range(0, len(xy_train), block_size):
+            min_distances, _ = tree.query(xy_train[start:start + block_size])
+            max_distance = max(max_distance, np.max(min_distances))
 
         # Return the maximum of these minimum distances
-        return np.max(min_distances)
+        return max_distance
 
-    def validate_deviation(self, x_value, y_value, xy_func: pd.DataFrame, max_deviation):
+    def validate_deviation(self, x_value, y_value, xy_func, max_deviation):
         """
         Validate if the (x,y) coordiate fit into the max_diviation of the xy_func
 
         :param x_value: x value of coordinate
         :param y_value: y value of coordinate
-        :param xy_func: function to validate with
+        :param xy_func: function to validate with, as data frame or as nearest neighbour index from get_nn_index
         :param max_deviation: maximum deviation to function
         :return: If validatet the deviation of the coordinate, otherwise None
         """
-        # Find the closest point on the curve
-        distances = np.sqrt((xy_func.iloc[:, 0] - x_value)**2 + (xy_func.iloc[:, 1] - y_value)**2)
-        closest_index = distances.idxmin()
+        if not isinstance(xy_func, pd.DataFrame):
+            # Calculate the Euclidean distance to the closest point on the curve, inf if it is further away than max_deviation
+            if np.isnan(max_deviation):
+                return None
+            deviation, _ = xy_func.query([x_value, y_value], distance_upper_bound=np.nextafter(max_deviation, np.inf))
+        else:
+            # Find the closest point on the curve
+            distances = np.sqrt((xy_func.iloc[:, 0] - x_value)**2 + (xy_func.iloc[:, 1] - y_value)**2)
+            closest_index = distances.idxmin()
 
-        x_value_func = xy_func.iloc[closest_index, 0]
-        y_value_func = xy_func.iloc[closest_index, 1]
+            x_value_func = xy_func.iloc[closest_index, 0]
+            y_value_func = xy_func.iloc[closest_index, 1]
 
-        # Calculate the Euclidean distance
-        deviation = np.sqrt((x_value - x_value_func)**2 + (y_value - y_value_func)**2)
+            # Calculate the Euclidean distance
+            deviation = np.sqrt((x_value - x_value_func)**2 + (y_value - y_value_func)**2)
 
         # Check if deviation doesn't exceed max_deviation
         if deviation <= max_deviation :
@@ -81,6 +251,65 @@ class LogicManager:
         # Coordinate could not be validated
         return None
 
+    def get_nn_index(self, dataFrame_ideal:pd.DataFrame, func_id):
+        """
+        Get the nearest neighbour index of an ideal function, the index is build on first use and
+        reused afterwards. Passing another ideal data frame drops all cached indexes
+
+        :param dataFrame_ideal: all ideal function
+        :param func_id: column index of the ideal function
+        :return: KD-tree over the points of the function
+        """
+        # Rebuild the indexes if the ideal data changed
+        if self._nn_index_source is not dataFrame_ideal:
+            self.invalidate_nn_indexes()
+            self._nn_index_source = dataFrame_ideal
+
+        func_id = int(func_id)
+        if func_id not in self._nn_indexes:
+            self._nn_indexes[func_id] = self._build_nn_index(dataFrame_ideal.iloc[:, [0, func_id]])
+
+        return self._nn_indexes[func_id]
+
+    def get_ideal_norms(self, dataFrame_ideal:pd.DataFrame):
+        """
+        Get the squared norms ||Y||² of all ideal functions, computed on first use and reused by
+        get_best_fit_functions for the same ideal data frame. Passing another ideal data frame drops all cached indexes
+
+        :param dataFrame_ideal: all ideal function
+        :return: array with one squared norm per ideal function
+        """
+        # Recompute if the ideal data changed
+        if self._nn_index_source is not dataFrame_ideal:
+            self.invalidate_nn_indexes()
+            self._nn_index_source = dataFrame_ideal
+
+        if self._ideal_norms is None:
+            y_ideal = dataFrame_ideal.iloc[:, 1:].to_numpy(dtype=np.float64)
+            self._ideal_norms = np.einsum('ij,ij->j', y_ideal, y_ideal)
+
+        return self._ideal_norms
+
+    def invalidate_nn_indexes(self):
+        """
+        Drop all cached nearest neighbour indexes and norms, needed after the ideal data frame was changed in place
+        """
+        self._nn_indexes = {}
+        self._nn_index_source = None
+        self._ideal_norms = None
+
+    def cached_bytes(self):
+        """
+        Estimate the memory of the cached nearest neighbour indexes and norms
+
+        :return: size in bytes
+        """
+        size = 0 if self._ideal_norms is None else self._ideal_norms.nbytes
+        for tree in self._nn_indexes.values():
+            # Points, their order and roughly as much again for the tree nodes
+            size += 2 * (tree.data.nbytes + tree.indices.nbytes)
+        return size
+
 
     def find_best_function_test(self, x_value, y_value, dataFrame_ideal:pd.DataFrame, pd_func_max_div:pd.DataFrame):
         """
@@ -100,7 +329,7 @@ class LogicManager:
             func_id = row['func_id']
             max_div = row['max_div']
 
-            deviation = self.validate_deviation(x_value, y_value, dataFrame_ideal.iloc[:, [0, func_id]], max_div)
+            deviation = self.validate_deviation(x_value, y_value, self.get_nn_index(dataFrame_ideal, func_id), max_div)
 
             # Check if the result is the better option
             if deviation != None:
@@ -111,3 +340,384 @@ class LogicManager:
         # Return solution
         return best_deviation, best_function
 
+    def classify_batch(self, test_xy, dataFrame_ideal:pd.DataFrame, pd_func_max_div:pd.DataFrame):
+        """
+        Find the best fitting function and its deviation for all test coordinates at once,
+        with the same rules as find_best_function_test
+
+        :param test_xy: array of (x, y) test coordinates
+        :param dataFrame_ideal: all ideal function
+        :param pd_func_max_div: array with (choosen function, max deviation)
+        :return: arrays with the best deviation and the best fitting function, NaN if no function fits
+        """
+        test_xy = np.atleast_2d(np.asarray(test_xy, dtype=self.dtype))
+        best_deviation = np.full(len(test_xy), np.nan)
+        best_function = np.full(len(test_xy), np.nan)
+
+        # Loop over all functions
+        for func_id, max_div in zip(pd_func_max_div['func_id'], pd_func_max_div['max_div']):
+            # No coordinate fits a function without max deviation
+            if np.isnan(max_div):
+                continue
+
+            # Distance to the closest point of the function, inf if it is further away than max_div
+            tree = self.get_nn_index(dataFrame_ideal, func_id)
+            deviation, _ = tree.query(test_xy, distance_upper_bound=np.nextafter(max_div, np.inf))
+
+            # Check which coordinates fit and are the better option
+            better = (deviation <= max_div) & (np.isnan(best_deviation) | (deviation < best_deviation))
+            best_deviation[better] = deviation[better]
+            best_function[better] = func_id
+
+        # Return solution
+        return best_deviation, best_function
+
+    def _build_nn_index(self, xy_func:pd.DataFrame):
+        """
+        Build a nearest neighbour index over the (x, y) points of a function, points with missing values are left out
+
+        :param xy_func: function to index
+        :return: KD-tree over the points of the function
+        """
+        from scipy.spatial import cKDTree
+        xy = xy_func.to_numpy(dtype=np.float64)
+        return cKDTree(xy[np.isfinite(xy).all(axis=1)])
+
+    @contextlib.contextmanager
+    def classify_pool(self, dataFrame_ideal:pd.DataFrame, pd_func_max_div:pd.DataFrame, workers=None, ideal_snapshot=None):
+        """
+        Start the worker processes of classify_parallel once, so several calls (e.g. one per test chunk)
+        share them. Every worker opens the memory mapped ideal matrix once
+
+        :param dataFrame_ideal: all ideal function
+        :param pd_func_max_div: array with (choosen function, max deviation)
+        :param workers: amount of worker processes, all cores if None
+        :param ideal_snapshot: path of a .npy snapshot of dataFrame_ideal (see DatabaseManager.ideal_snapshot_path), a temporary one is written if None
+        :return: executor to hand to classify_parallel
+        """
+        workers = workers or os.cpu_count() or 1
+
+        # Write the ideal matrix once, so it is not pickled per task
+        temp_path = None
+        if ideal_snapshot is None:
+            file_descriptor, temp_path = tempfile.mkstemp(suffix='.npy')
+            with os.fdopen(file_descriptor, 'wb') as file:
+                np.save(file, dataFrame_ideal.to_numpy(dtype=self.dtype))
+            ideal_snapshot = temp_path
+
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_classify_worker,
+                                     initargs=(ideal_snapshot, list(dataFrame_ideal.columns), pd_func_max_div)) as executor:
+                yield executor
+
+        finally:
+            if temp_path is not None:
+                os.remove(temp_path)
+
+    def classify_parallel(self, test_xy, dataFrame_ideal:pd.DataFrame, pd_func_max_div:pd.DataFrame, workers=None, shard_size=100000, ideal_snapshot=None, executor=None):
+        """
+        Classify all test coordinates like classify_batch, but split into shards which are classified
+        in a process pool. The ideal matrix is handed to the workers once as memory mapped file
+
+        :param test_xy: array of (x, y) test coordinates
+        :param dataFrame_ideal: all ideal function
+        :param pd_func_max_div: array with (choosen function, max deviation)
+        :param workers: amount of worker processes, all cores if None
+        :param shard_size: amount of test coordinates per shard
+        :param ideal_snapshot: path of a .npy snapshot of dataFrame_ideal (see DatabaseManager.ideal_snapshot_path), a temporary one is written if None
+        :param executor: pool from classify_pool started for the same ideal data and functions, a pool for this call only is started if None
+        :return: arrays with the best deviation and the best fitting function, NaN if no function fits
+        """
+        test_xy = np.atleast_2d(np.asarray(test_xy, dtype=self.dtype))
+        workers = workers or os.cpu_count() or 1
+
+        # Not worth using a pool
+        if (executor is None and workers == 1) or len(test_xy) <= shard_size:
+            return self.classify_batch(test_xy, dataFrame_ideal, pd_func_max_div)
+
+        # Pool for this call only
+        if executor is None:
+            with self.classify_pool(dataFrame_ideal, pd_func_max_div, workers, ideal_snapshot) as executor:
+                return self.classify_parallel(test_xy, dataFrame_ideal, pd_func_max_div, workers, shard_size, executor=executor)
+
+        # map keeps the order of the shards
+        shards = [test_xy[start:start + shard_size] for start in range(0, len(test_xy), shard_size)]
+        results = list(executor.map(_classify_shard, shards))
+
+        # Merge the shards in their original order
+        best_deviation = np.concatenate([result[0] for result in results])
+        best_function = np.concatenate([result[1] for result in results])
+        return best_deviation, best_function
+
+    def precision_report(self, dataFrame_train:pd.DataFrame, dataFrame_ideal:pd.DataFrame, test_xy=None) -> dict:
+        '''
+        Compare the fit (and classification) of this precision with a float64 run on the same data
+
+        :param dataFrame_train: x column followed by the train functions
+        :param dataFrame_ideal: x column followed by all possible ideal functions in full precision
+        :param test_xy: array of (x, y) test coordinates to compare the classification as well, skipped if None
+        :return: dict with the amount of differing chosen functions, the max absolute and relative
+                 difference of the max deviations and, with test_xy, the amount of differently
+                 classified coordinates and the max absolute difference of their deviations
+        '''
+        reference = LogicManager(dtype=np.float64)
+        reference_fit = reference.fit_functions(dataFrame_train, dataFrame_ideal)
+        compact_ideal = dataFrame_ideal.astype(self.dtype)
+        compact_fit = self.fit_functions(dataFrame_train, compact_ideal)
+
+        max_div_error = np.abs(compact_fit['max_div'].to_numpy() - reference_fit['max_div'].to_numpy())
+        report = {
+            'dtype': self.dtype.name,
+            'func_id_mismatches': int((compact_fit['func_id'] != reference_fit['func_id']).sum()),
+            'max_div_abs_error': float(np.nanmax(max_div_error, initial=0.0)),
+            'max_div_rel_error': float(np.nanmax(max_div_error / np.abs(reference_fit['max_div'].to_numpy()), initial=0.0)),
+        }
+
+        if test_xy is not None:
+            # Both runs use the float64 fit, so only the precision of the classification is compared
+            reference_deviation, reference_function = reference.classify_batch(test_xy, dataFrame_ideal, reference_fit)
+            compact_deviation, compact_function = self.classify_batch(test_xy, compact_ideal, reference_fit)
+            both = ~np.isnan(reference_deviation) & ~np.isnan(compact_deviation)
+            report['classification_mismatches'] = int((~((reference_function == compact_function)
+                                                         | (np.isnan(reference_function) & np.isnan(compact_function)))).sum())
+            report['deviation_abs_error'] = float(np.max(np.abs(reference_deviation[both] - compact_deviation[both]), initial=0.0))
+
+        return report
+
+class IncrementalFitter:
+    def __init__(self, train_functions, ideal_functions, dtype=np.float64) -> None:
+        '''
+        Keeps running fit statistics of training data arriving in batches, so the best fit can be
+        read at any time without processing the earlier batches again. Per (train function, ideal function)
+        pair the sum of squared errors and the max absolute residual at the same x are accumulated
+
+        :param train_functions: amount of train functions k
+        :param ideal_functions: amount of ideal functions m
+        :param dtype: precision of the residuals of a batch, the sums are always reduced in float64
+        '''
+        self.dtype = np.dtype(dtype)
+        self.sse = np.zeros((train_functions, ideal_functions))
+        self.max_residual = np.zeros((train_functions, ideal_functions))
+        self.rows = 0
+
+    def update(self, xy_train_batch:pd.DataFrame, xy_ideal_batch:pd.DataFrame):
+        '''
+        Add a batch of training rows in O(batch x k x m)
+
+        :param xy_train_batch: x column followed by the k train functions
+        :param xy_ideal_batch: rows of the ideal functions at the same x values, x column followed by the m functions
+        :return: amount of rows added so far
+        '''
+        # Ensure x values match
+        if not np.array_equal(xy_train_batch.iloc[:, 0].to_numpy(dtype=self.dtype), xy_ideal_batch.iloc[:, 0].to_numpy(dtype=self.dtype)):
+            raise ValueError("X values in training and ideal datasets do not match")
+
+        return self.add_rows(xy_train_batch.iloc[:, 1:].to_numpy(dtype=self.dtype), xy_ideal_batch.iloc[:, 1:].to_numpy(dtype=self.dtype))
+
+    def add_rows(self, y_train:np.ndarray, y_ideal:np.ndarray):
+        '''
+        Add a batch of training rows without x column, the rows of both arrays belong to the same x values
+
+        :param y_train: values of the k train functions (batch x k)
+        :param y_ideal: values of the m ideal functions (batch x m)
+        :return: amount of rows added so far
+        '''
+        y_train = np.asarray(y_train, dtype=self.dtype)
+        y_ideal = np.asarray(y_ideal, dtype=self.dtype)
+        if y_train.shape[1] != self.sse.shape[0] or y_ideal.shape[1] != self.sse.shape[1]:
+            raise ValueError(f"Expected {self.sse.shape[0]} train and {self.sse.shape[1]} ideal functions")
+
+        if len(y_train) > 0:
+            # One train function at a time keeps the residuals at batch x m
+            for column in range(y_train.shape[1]):
+                residuals = y_ideal - y_train[:, [column]]
+                self.sse[column] += np.einsum('ij,ij->j', residuals, residuals, dtype=np.float64)
+                self.max_residual[column] = np.maximum(self.max_residual[column], np.abs(residuals).max(axis=0))
+            self.rows += len(y_train)
+
+        return self.rows
+
+    def get_best_fit_functions(self) -> np.ndarray:
+        '''
+        Find the best fitting ideal function for every train function from the rows added so far,
+        with the same rules as LogicManager.get_best_fit_functions
+
+        :return: array with the column index of the best fitting ideal function for each train function
+        '''
+        # Functions containing NaN can never be the best fit
+        deviations = np.where(np.isnan(self.sse), np.inf, self.sse)
+        best_functions = np.argmin(deviations, axis=1) + 1
+
+        # No function found
+        best_functions[np.all(np.isinf(deviations), axis=1) | (self.rows == 0)] = -1
+        return best_functions
+
+    def fit_functions(self) -> pd.DataFrame:
+        '''
+        Best fitting ideal function for every train function and the max deviation a test coordinate may have to it.
+        The max deviation is based on the max residual at the same x, an upper bound of the Euclidean max deviation
+        of LogicManager.calculate_max_deviation, so test coordinates are accepted at least as often as after a full fit
+
+        :return: array with (choosen function, max deviation), max deviation NaN if no function was found
+        '''
+        ideal_for_train = self.get_best_fit_functions()
+        max_residual = np.full(len(ideal_for_train), np.nan)
+        found = ideal_for_train > 0
+        max_residual[found] = self.max_residual[found, ideal_for_train[found] - 1]
+
+        return pd.DataFrame({'func_id': ideal_for_train.astype(np.int64),
+                             'max_div': max_residual * TEST_DEVIATION_FACTOR})
+
+class IdealLibraryRegistry:
+    def __init__(self, memory_budget_bytes=1024**3, dtype=np.float64) -> None:
+        '''
+        Manages several named ideal libraries in one process. A library is loaded on first use together with
+        its norms, its nearest neighbour indexes are built when first needed. The least recently used
+        libraries are evicted as soon as all loaded libraries need more than memory_budget_bytes
+
+        :param memory_budget_bytes: memory of all loaded libraries, the library in use is never evicted
+        :param dtype: precision of the LogicManager of every library (np.float64 or np.float32)
+        '''
+        self.memory_budget_bytes = memory_budget_bytes
+        self.dtype = np.dtype(dtype)
+
+        # Loader per library name and the loaded libraries from least to most recently used
+        self._loaders = {}
+        self._libraries = OrderedDict()
+
+        # Counters for the stats
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def register(self, name, loader):
+        '''
+        Register a library, it is not loaded yet. A registered name gets the new loader and its loaded data is dropped
+
+        :param name: name of the library
+        :param loader: callable without arguments returning the ideal data frame (x column followed by the functions),
+                       e.g. lambda: db_manager.load_ideal_snapshot('./data/ideal.csv')
+        '''
+        self._loaders[name] = loader
+        self.evict(name)
+
+    def unregister(self, name):
+        '''
+        Remove a library and drop its loaded data
+
+        :param name: name of the library
+        '''
+        self._loaders.pop(name, None)
+        self.evict(name)
+
+    def get(self, name):
+        '''
+        Get a library, it is loaded if needed and marked as most recently used
+
+        :param name: name of the library
+        :return: ideal data frame and the LogicManager holding the norms and nearest neighbour indexes of the library
+        '''
+        if name not in self._loaders:
+            raise KeyError(f"Ideal library {name} is not registered")
+
+        if name in self._libraries:
+            self._hits += 1
+            self._libraries.move_to_end(name)
+        else:
+            self._misses += 1
+            start_time = time.perf_counter()
+            dataFrame_ideal = self._loaders[name]()
+
+            # Precompute the norms of the fit
+            lgc_manager = LogicManager(dtype=self.dtype)
+            lgc_manager.get_ideal_norms(dataFrame_ideal)
+            self._libraries[name] = {'ideal': dataFrame_ideal, 'logic': lgc_manager,
+                                     'load_seconds': time.perf_counter() - start_time}
+            self._evict_over_budget()
+
+        library = self._libraries[name]
+        return library['ideal'], library['logic']
+
+    def fit_functions(self, name, dataFrame_train:pd.DataFrame, fit_cache=None) -> pd.DataFrame:
+        '''
+        Fit train functions against a library, see LogicManager.fit_functions
+
+        :param name: name of the library
+        :param dataFrame_train: x column followed by the train functions
+        :param fit_cache: store with get_fit_result(key) and put_fit_result(key, result), no memoization if None
+        :return: array with (choosen function, max deviation)
+        '''
+        dataFrame_ideal, lgc_manager = self.get(name)
+        return lgc_manager.fit_functions(dataFrame_train, dataFrame_ideal, fit_cache)
+
+    def classify_batch(self, name, test_xy, pd_func_max_div:pd.DataFrame):
+        '''
+        Classify test coordinates against a library, see LogicManager.classify_batch. Nearest
+        neighbour indexes built by the call count towards the memory budget
+
+        :param name: name of the library
+        :param test_xy: array of (x, y) test coordinates
+        :param pd_func_max_div: array with (choosen function, max deviation) fitted against the library
+        :return: arrays with the best deviation and the best fitting function, NaN if no function fits
+        '''
+        dataFrame_ideal, lgc_manager = self.get(name)
+        result = lgc_manager.classify_batch(test_xy, dataFrame_ideal, pd_func_max_div)
+        self._evict_over_budget()
+        return result
+
+    def evict(self, name):
+        '''
+        Drop the loaded data of a library, it is loaded again on the next use
+
+        :param name: name of the library
+        :return: True if the library was loaded
+        '''
+        return self._libraries.pop(name, None) is not None
+
+    def loaded(self):
+        '''
+        Names of the loaded libraries
+
+        :return: list from least to most recently used
+        '''
+        return list(self._libraries)
+
+    def memory_usage(self, name=None):
+        '''
+        Estimate the memory of loaded libraries: ideal matrix, norms and nearest neighbour indexes
+
+        :param name: name of a library, all loaded libraries if None
+        :return: size in bytes, 0 if the library is not loaded
+        '''
+        if name is None:
+            return sum(self.memory_usage(loaded_name) for loaded_name in self._libraries)
+        if name not in self._libraries:
+            return 0
+
+        library = self._libraries[name]
+        return int(library['ideal'].memory_usage(index=False).sum()) + library['logic'].cached_bytes()
+
+    def get_stats(self):
+        '''
+        Usage of the registry
+
+        :return: dict with registered and loaded libraries, memory usage, hits, misses and evictions
+        '''
+        return {
+            'registered': len(self._loaders),
+            'loaded': self.loaded(),
+            'memory_bytes': self.memory_usage(),
+            'memory_budget_bytes': self.memory_budget_bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+        }
+
+    def _evict_over_budget(self):
+        '''
+        Evict the least recently used libraries until the loaded libraries fit into the memory budget
+        '''
+        while len(self._libraries) > 1 and self.memory_usage() > self.memory_budget_bytes:
+            self._libraries.popitem(last=False)
+            self._evictions += 1
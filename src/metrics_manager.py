@@ -0,0 +1,232 @@
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is only known with trace_memory
+    resource = None
+
+# Methods instrumented by default, as (module, class name, method names)
+DEFAULT_TARGETS = [
+    ('src.sql_manager', 'DatabaseManager', ['csv_2DArray', 'load_table', 'load_ideal_snapshot', 'import_trainCSV',
+                                            'import_idealCSV', 'bulk_import_dataframe', 'testDB_add_records']),
+    ('src.columnar_manager', 'ColumnarManager', ['load_table', 'bulk_import_dataframe', 'testDB_add_records']),
+    ('src.logic_manager', 'LogicManager', ['fit_functions', 'get_best_fit_functions', 'calculate_max_deviation',
+                                           'classify_batch', 'classify_parallel', 'find_best_function_test']),
+    ('src.visual_manager', 'VisualManger', ['visualize_data_and_deviations']),
+]
+
+class MetricsManager:
+    def __init__(self, trace_memory=False):
+        '''
+        Records wall time, call count, processed rows and memory per pipeline stage.
+        The methods are only wrapped while the metrics are enabled, so disabled metrics cost nothing
+
+        :param trace_memory: if True the peak memory of every stage is traced with tracemalloc (slow, peak_memory_bytes),
+                             otherwise the peak resident memory of the process after the stage (process_peak_rss_bytes)
+                             and how much the stage raised it (peak_rss_increase_bytes) are recorded
+        '''
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._originals = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self, targets=None):
+        '''
+        Wrap the methods of the targets, so every call is recorded as a stage
+
+        :param targets: list of (module, class name, method names), DEFAULT_TARGETS if None
+        '''
+        if self._originals:
+            return
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        for module_name, class_name, method_names in targets or DEFAULT_TARGETS:
+            module = __import__(module_name, fromlist=[class_name])
+            cls = getattr(module, class_name)
+            for method_name in method_names:
+                original = cls.__dict__[method_name]
+                self._originals.append((cls, method_name, original))
+                setattr(cls, method_name, self._wrap(f'{class_name}.{method_name}', original))
+
+    def disable(self):
+        '''
+        Restore the original methods, the recorded stages are kept
+        '''
+        for cls, method_name, original in reversed(self._originals):
+            setattr(cls, method_name, original)
+        self._originals = []
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        '''
+        Drop all recorded stages
+        '''
+        with self._lock:
+            self.stages = {}
+
+    def record(self, name, seconds, rows=None, peak_memory=None, process_peak_rss=None, rss_increase=None):
+        '''
+        Add one call of a stage, the memory values keep their maximum over all calls
+
+        :param name: name of the stage
+        :param seconds: wall time of the call
+        :param rows: amount of processed rows or None if unknown
+        :param peak_memory: traced peak memory in bytes during the call
+        :param process_peak_rss: peak resident memory of the process in bytes after the call
+        :param rss_increase: bytes the call raised the peak resident memory of the process by
+        '''
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_time_seconds': 0.0, 'rows': 0})
+            stage['calls'] += 1
+            stage['wall_time_seconds'] += seconds
+            if rows is not None:
+                stage['rows'] += int(rows)
+            for key, value in (('peak_memory_bytes', peak_memory), ('process_peak_rss_bytes', process_peak_rss),
+                               ('peak_rss_increase_bytes', rss_increase)):
+                if value is not None:
+                    stage[key] = max(stage.get(key, 0), int(value))
+
+    def to_json(self, path=None):
+        '''
+        Export the recorded stages as JSON
+
+        :param path: file to write to, only returned if None
+        :return: JSON text
+        '''
+        text = json.dumps({'stages': self.stages}, indent=2)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def to_prometheus(self, path=None):
+        '''
+        Export the recorded stages in the Prometheus text format
+
+        :param path: file to write to, only returned if None
+        :return: Prometheus text
+        '''
+        metrics = [
+            ('pipeline_stage_calls_total', 'counter', 'Calls of the stage', 'calls'),
+            ('pipeline_stage_wall_time_seconds_total', 'counter', 'Wall time spent in the stage', 'wall_time_seconds'),
+            ('pipeline_stage_rows_total', 'counter', 'Rows processed by the stage', 'rows'),
+            ('pipeline_stage_peak_memory_bytes', 'gauge', 'Traced peak memory during the stage', 'peak_memory_bytes'),
+            ('pipeline_stage_process_peak_rss_bytes', 'gauge', 'Peak resident memory of the process after the stage', 'process_peak_rss_bytes'),
+            ('pipeline_stage_peak_rss_increase_bytes', 'gauge', 'Increase of the peak resident memory by the stage', 'peak_rss_increase_bytes'),
+        ]
+        lines = []
+        for metric_name, metric_type, description, key in metrics:
+            # Memory metrics of the other mode are left out
+            values = [(stage_name, stage[key]) for stage_name, stage in self.stages.items() if key in stage]
+            if not values:
+                continue
+            lines.append(f'# HELP {metric_name} {description}')
+            lines.append(f'# TYPE {metric_name} {metric_type}')
+            for stage_name, value in values:
+                lines.append(f'{metric_name}{{stage="{stage_name}"}} {value}')
+        text = '\n'.join(lines) + '\n'
+
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def export(self, path):
+        '''
+        Export the recorded stages, Prometheus text for .prom and .txt files, JSON otherwise
+
+        :param path: file to write to
+        '''
+        if path.endswith(('.prom', '.txt')):
+            self.to_prometheus(path)
+        else:
+            self.to_json(path)
+
+    def _wrap(self, name, method):
+        '''
+        Wrap a method, so its calls are recorded
+
+        :param name: stage name
+        :param method: method to wrap
+        :return: wrapped method
+        '''
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            # Peaks of nested stages are handed to the enclosing stage
+            stack = self._local.__dict__.setdefault('peaks', [])
+            if self.trace_memory:
+                # Keep the peak the enclosing stage reached so far before it is reset
+                if stack:
+                    stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            stack.append(0)
+            rss_before = None if self.trace_memory else _process_peak_memory()
+
+            start_time = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start_time
+                child_peak = stack.pop()
+                peak_memory = process_peak_rss = rss_increase = None
+                if self.trace_memory:
+                    peak_memory = max(tracemalloc.get_traced_memory()[1], child_peak)
+                    if stack:
+                        stack[-1] = max(stack[-1], peak_memory)
+                else:
+                    # The process peak only rises, its increase is what the stage needed beyond all earlier stages
+                    process_peak_rss = _process_peak_memory()
+                    if process_peak_rss is not None:
+                        rss_increase = process_peak_rss - rss_before
+
+            self.record(name, seconds, _count_rows(args, result), peak_memory, process_peak_rss, rss_increase)
+            return result
+
+        return wrapper
+
+def _count_rows(args, result):
+    '''
+    Get the amount of processed rows of a stage, from its first data argument or from its return value
+
+    :param args: positional arguments of the stage, including self
+    :param result: return value of the stage
+    :return: amount of rows or None if unknown
+    '''
+    # Rows handed into the stage
+    if len(args) > 1 and isinstance(args[1], (pd.DataFrame, np.ndarray)):
+        return len(args[1])
+
+    # Rows returned or reported by the stage
+    if isinstance(result, (bool, np.bool_)):
+        return None
+    if isinstance(result, (int, np.integer)):
+        return result
+    if isinstance(result, (pd.DataFrame, np.ndarray)):
+        return len(result)
+    if isinstance(result, tuple) and len(result) > 0 and isinstance(result[0], np.ndarray):
+        return len(result[0])
+    return None
+
+def _process_peak_memory():
+    '''
+    Get the peak resident memory of the process
+
+    :return: peak memory in bytes or None if unknown
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
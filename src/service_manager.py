@@ -0,0 +1,207 @@
+import asyncio
+import json
+import time
+from collections import deque
+import numpy as np
+import pandas as pd
+
+class ServiceManager:
+    def __init__(self, db_manager, lgc_manager, dataFrame_ideal:pd.DataFrame, pd_func_max_div:pd.DataFrame,
+                 max_batch_size=8192, max_batch_delay=0.002, write_results=True):
+        '''
+        Keeps the fitted functions in memory and classifies test coordinates of concurrent
+        requests together in micro batches
+
+        :param db_manager: database manager to write the results with
+        :param lgc_manager: logic manager to classify with
+        :param dataFrame_ideal: all ideal function
+        :param pd_func_max_div: array with (choosen function, max deviation)
+        :param max_batch_size: amount of coordinates which closes a micro batch
+        :param max_batch_delay: seconds a micro batch waits for further requests
+        :param write_results: if True the results are written into the service table (service_db) in the background,
+                              apart from the test csv results in test_db
+        '''
+        self.db_manager = db_manager
+        self.lgc_manager = lgc_manager
+        self.dataFrame_ideal = dataFrame_ideal
+        self.pd_func_max_div = pd_func_max_div
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.write_results = write_results
+
+        # Latency of the last requests in seconds and overall counters for the stats
+        self._latencies = deque(maxlen=100000)
+        self._requests = 0
+        self._points = 0
+        self._batches = 0
+        self._start_time = time.perf_counter()
+
+        # Created inside the running event loop
+        self._request_queue = None
+        self._write_queue = None
+
+    async def classify(self, test_xy):
+        '''
+        Classify test coordinates, the call is grouped with concurrent calls into one micro batch
+
+        :param test_xy: array of (x, y) test coordinates
+        :return: arrays with the best deviation and the best fitting function, NaN if no function fits
+        '''
+        test_xy = np.asarray(test_xy, dtype=np.float64).reshape(-1, 2)
+        start_time = time.perf_counter()
+
+        future = asyncio.get_running_loop().create_future()
+        await self._request_queue.put((test_xy, future))
+        result = await future
+
+        self._latencies.append(time.perf_counter() - start_time)
+        self._requests += 1
+        return result
+
+    def get_stats(self):
+        '''
+        Latency and throughput of the service
+
+        :return: dict with request, point and batch counts, points per second and p50/p99 latency in ms
+        '''
+        latencies = np.array(self._latencies)
+        elapsed = time.perf_counter() - self._start_time
+        return {
+            'requests': self._requests,
+            'points': self._points,
+            'batches': self._batches,
+            'points_per_second': self._points / max(elapsed, 1e-9),
+            'latency_p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+        }
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        '''
+        Accept newline delimited JSON requests on a local socket until cancelled.
+        Request {"points": [[x, y], ...]} is answered with {"deviation": [...], "func_id": [...]},
+        request {"stats": true} with the stats of the service
+
+        :param host: host to listen on
+        :param port: port to listen on
+        '''
+        await self.start()
+        server = await asyncio.start_server(self._handle_client, host, port)
+        print(f"Classification service listening on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def start(self):
+        '''
+        Start the micro batching and the result writing inside the running event loop
+        '''
+        self._request_queue = asyncio.Queue()
+        self._write_queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._batch_loop()), asyncio.create_task(self._write_loop())]
+
+    async def stop(self):
+        '''
+        Stop the background tasks after all queued results have been written
+        '''
+        await self._write_queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _batch_loop(self):
+        '''
+        Collect queued requests into micro batches and classify each batch with one vectorized call
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for the first request, then collect more until the batch is full or the delay passed
+            batch = [await self._request_queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_batch_delay
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._request_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                size += len(batch[-1][0])
+
+            test_xy = np.concatenate([entry[0] for entry in batch])
+            try:
+                # Classify outside of the event loop, so new requests can be accepted meanwhile
+                deviations, func_ids = await loop.run_in_executor(
+                    None, self.lgc_manager.classify_batch, test_xy, self.dataFrame_ideal, self.pd_func_max_div)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self._points += len(test_xy)
+            self._batches += 1
+            if self.write_results:
+                self._write_queue.put_nowait((test_xy, deviations, func_ids))
+
+            # Hand every request its part of the batch
+            start = 0
+            for entry_xy, future in batch:
+                stop = start + len(entry_xy)
+                if not future.done():
+                    future.set_result((deviations[start:stop], func_ids[start:stop]))
+                start = stop
+
+    async def _write_loop(self):
+        '''
+        Write the classified batches into the service table without blocking the requests
+        '''
+        loop = asyncio.get_running_loop()
+        test_writer = self.db_manager.create_test_writer(table_name='service_db')
+        while True:
+            # Take everything queued so far and write it in one transaction
+            entries = [await self._write_queue.get()]
+            while not self._write_queue.empty():
+                entries.append(self._write_queue.get_nowait())
+
+            for test_xy, deviations, func_ids in entries:
+                test_writer.add(test_xy[:, 0], test_xy[:, 1], deviations, func_ids)
+            await loop.run_in_executor(None, test_writer.flush)
+
+            for _ in entries:
+                self._write_queue.task_done()
+
+    async def _handle_client(self, reader, writer):
+        '''
+        Answer the requests of one connection, one JSON object per line
+
+        :param reader: stream to read the requests from
+        :param writer: stream to write the responses to
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if request.get('stats'):
+                        response = self.get_stats()
+                    else:
+                        deviations, func_ids = await self.classify(request['points'])
+                        # NaN is not valid JSON, unmatched coordinates are answered with null
+                        response = {
+                            'deviation': [None if np.isnan(value) else float(value) for value in deviations],
+                            'func_id': [None if np.isnan(value) else int(value) for value in func_ids],
+                        }
+                except Exception as e:
+                    response = {'error': str(e)}
+
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+
+        finally:
+            writer.close()
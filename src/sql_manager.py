@@ -1,83 +1,668 @@
 import sqlalchemy as db
+import contextlib
+import csv
+import glob
+import functools
+import hashlib
+import importlib.util
+import os
+import re
+import time
 import pandas as pd
+import numpy as np
+
+# Column names of the database tables in table order
+TABLE_COLUMNS = {
+    'train_db': ['X'] + [f'Y{i} (training func)' for i in range(1, 5)],
+    'ideal_db': ['X'] + [f'Y{i} (ideal func)' for i in range(1, 51)],
+    'test_db': ['X (test func)', 'Y (test func)', 'Delta Y (test func)', 'No. of ideal func'],
+    'service_db': ['X (test func)', 'Y (test func)', 'Delta Y (test func)', 'No. of ideal func'],
+}
+
+# Pragmas for heavy read and write phases, WAL journal with relaxed syncing, 64 MB page cache and 256 MB memory map
+TUNED_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+@functools.lru_cache(maxsize=None)
+def csv_engine():
+    '''
+    Get the fastest available csv parser, the multi threaded pyarrow parser if pyarrow is installed
+
+    :return: engine name for pd.read_csv
+    '''
+    return 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+
+@functools.lru_cache(maxsize=None)
+def insert_sql(table_name, mode='plain'):
+    '''
+    Build the positional INSERT statement of a table once, sqlite reuses the prepared statement for the same text
+
+    :param table_name: name of the table
+    :param mode: 'plain', 'ignore' (skip rows violating a constraint) or 'upsert' (update rows with new values)
+    :return: SQL text with ? placeholders in the order of TABLE_COLUMNS
+    '''
+    columns = TABLE_COLUMNS[table_name]
+    column_string = ', '.join(f'`{column}`' for column in columns)
+    value_string = ', '.join('?' for _ in columns)
+
+    if mode == 'ignore':
+        return f"INSERT OR IGNORE INTO {table_name} ({column_string}) VALUES ({value_string})"
+    if mode == 'upsert':
+        # Only rows with new or modified values are written
+        update_string = ', '.join(f'`{column}` = excluded.`{column}`' for column in columns[1:])
+        changed_string = ' OR '.join(f'`{column}` IS NOT excluded.`{column}`' for column in columns[1:])
+        return (f"INSERT INTO {table_name} ({column_string}) VALUES ({value_string}) "
+                f"ON CONFLICT(`{columns[0]}`) DO UPDATE SET {update_string} WHERE {changed_string}")
+    return f"INSERT INTO {table_name} ({column_string}) VALUES ({value_string})"
 
 class DatabaseManager:
-    def __init__(self, db_path):
+    # Csv files from this size on are imported chunk wise with this amount of rows per transaction,
+    # so huge files are never held in memory at once
+    IMPORT_CHUNKED_FROM_BYTES = 256 * 1024**2
+    IMPORT_CHUNK_ROWS = 500000
+
+    def __init__(self, db_path, pragmas=None):
         '''
         Creats/Loads database engine
 
         :param db_path: path to the database
+        :param pragmas: dict of sqlite pragmas set on every new connection (e.g. TUNED_PRAGMAS), sqlite defaults if None
         '''
         # Create engine so it can be used in the whole class
+        self.db_path = db_path
         self.db_engine = db.create_engine(f'sqlite:///{db_path}')
+        self.pragmas = dict(pragmas or {})
+
+        # Set the pragmas once per pooled connection
+        if self.pragmas:
+            for name, value in self.pragmas.items():
+                if not name.isidentifier() or not re.fullmatch(r'-?\w+', str(value)):
+                    raise ValueError(f"Invalid pragma {name}={value}")
+            db.event.listen(self.db_engine, 'connect', self._set_pragmas)
+
+        # Reflected tables by name, so the schema is only read once
+        self._tables = {}
+
+        # Connection shared by all operations inside session()
+        self._connection = None
+
+        # Content hashes by (path, extra), reused while size and modification time of the file stay the same
+        self._file_hashes = {}
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        '''
+        Set the configured pragmas on a new sqlite connection
+
+        :param dbapi_connection: new sqlite connection
+        :param connection_record: pool record of the connection
+        '''
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        Keep one connection open for all operations inside the with block, instead of one
+        connection per operation. Each operation still commits on its own. Not thread safe
+
+        :return: the shared connection
+        '''
+        # Nested sessions reuse the outer connection
+        if self._connection is not None:
+            yield self._connection
+            return
+
+        self._connection = self.db_engine.connect()
+        try:
+            yield self._connection
+        finally:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self):
+        '''
+        Get the session connection or a new connection
+
+        :return: connection to the database
+        '''
+        if self._connection is not None:
+            return self._connection
+        return self.db_engine.connect()
+
+    def _release(self, connection):
+        '''
+        Close a connection from _connect, the session connection stays open
+
+        :param connection: connection to release
+        '''
+        if connection is not self._connection:
+            connection.close()
 
-    def load_table(self, table_name):
+    def get_table(self, table_name):
         '''
-        Loads table into a pandas data frame
+        Get the reflected table, the reflection is cached after the first call
+
+        :param table_name: name of the table
+        :return: sqlalchemy table
+        '''
+        if table_name not in self._tables:
+            self._tables[table_name] = db.Table(table_name, db.MetaData(), autoload_with=self.db_engine)
+        return self._tables[table_name]
+
+    def load_table(self, table_name, columns=None, x_range=None, chunk_size=50000):
+        '''
+        Loads table into a pandas data frame. The rows are read chunk wise straight into
+        float64 NumPy columns, without keeping one Python object per cell
 
         :param table_name: name of the table to load
+        :param columns: names of the columns to load, all columns if None
+        :param x_range: (min, max) of the X column to load, a bound can be None
+        :param chunk_size: amount of rows fetched at once
         :return: panda data frame of table
         '''
+        table = self.get_table(table_name)
+        column_names = list(table.columns.keys()) if columns is None else list(columns)
+        for name in column_names:
+            if name not in table.columns:
+                raise ValueError(f"Column {name} does not exist in {table_name}")
+
+        # Creation of SQL statement with column projection and x range filter
+        column_string = ', '.join(f'`{name}`' for name in column_names)
+        sql = f"SELECT {column_string} FROM {table_name}"
+        conditions = []
+        params = []
+        if x_range is not None:
+            x_column = next(name for name in table.columns.keys() if name.startswith('X'))
+            if x_range[0] is not None:
+                conditions.append(f"`{x_column}` >= ?")
+                params.append(float(x_range[0]))
+            if x_range[1] is not None:
+                conditions.append(f"`{x_column}` <= ?")
+                params.append(float(x_range[1]))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        return self._fetch_frame(sql, params, column_names, chunk_size)
+
+    def query_test_results(self, func_id=None, x_range=None, max_deviation=None, matched=None, columns=None, chunk_size=50000):
+        '''
+        Load only the classification results matching all given filters, the filters run in SQL
+        on the indexes of the test table
+
+        :param func_id: No. of ideal func (or list of them) to load
+        :param x_range: (min, max) of X (test func) to load, a bound can be None
+        :param max_deviation: load only results with Delta Y (test func) <= max_deviation
+        :param matched: True for results with a matched function only, False for unmatched only
+        :param columns: names of the columns to load, all columns if None
+        :param chunk_size: amount of rows fetched at once
+        :return: panda data frame of the matching results
+        '''
+        table = self.get_table('test_db')
+        column_names = list(table.columns.keys()) if columns is None else list(columns)
+        for name in column_names:
+            if name not in table.columns:
+                raise ValueError(f"Column {name} does not exist in test_db")
+
+        # Creation of SQL statement with all filters
+        conditions = []
+        params = []
+        if func_id is not None:
+            func_ids = [float(value) for value in np.atleast_1d(func_id)]
+            conditions.append(f"`No. of ideal func` IN ({', '.join('?' for _ in func_ids)})")
+            params.extend(func_ids)
+        if x_range is not None:
+            if x_range[0] is not None:
+                conditions.append("`X (test func)` >= ?")
+                params.append(float(x_range[0]))
+            if x_range[1] is not None:
+                conditions.append("`X (test func)` <= ?")
+                params.append(float(x_range[1]))
+        if max_deviation is not None:
+            conditions.append("`Delta Y (test func)` <= ?")
+            params.append(float(max_deviation))
+        if matched is not None:
+            conditions.append("`No. of ideal func` IS NOT NULL" if matched else "`No. of ideal func` IS NULL")
+
+        sql = f"SELECT {', '.join(f'`{name}`' for name in column_names)} FROM test_db"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        return self._fetch_frame(sql, params, column_names, chunk_size)
+
+    def _fetch_frame(self, sql, params, column_names, chunk_size):
+        '''
+        Run a SELECT statement and read its rows chunk wise into float64 columns
 
-        table = db.Table(table_name, db.MetaData(), autoload_with=self.db_engine)
-        select_statement = db.select(table)
-        # Connect to database and get the table
-        with self.db_engine.connect() as connection:
-            result = connection.execute(select_statement)
+        :param sql: SELECT statement with ? placeholders
+        :param params: values of the placeholders
+        :param column_names: names of the selected columns
+        :param chunk_size: amount of rows fetched at once
+        :return: panda data frame of the result
+        '''
+        # Connect to database and fetch the table chunk wise, NULL becomes NaN
+        blocks = []
+        connection = self._connect()
+        try:
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    blocks.append(np.array(rows, dtype=np.float64))
+            finally:
+                cursor.close()
+        finally:
+            self._release(connection)
 
-            # Fetch all results into a list of tuples
-            rows = result.fetchall()
+        # Convert table into a dataframe
+        values = np.concatenate(blocks) if blocks else np.empty((0, len(column_names)))
+        return pd.DataFrame({name: values[:, i] for i, name in enumerate(column_names)})
 
-            # Convert table into a dataframe
-            column_names = table.columns.keys()
-            df = pd.DataFrame(rows, columns=column_names)
+    def csv_2DArray(self, directory, dtype=np.float64):
+        '''
+        Read csv file into a pandas data frame. All columns are parsed as dtype instead of
+        inferring their types, with the multi threaded pyarrow parser if available
 
-            return df
+        :param directory: directory of csv file
+        :param dtype: type of all columns
+        :return: panda data frame of csv file
+        '''
+        return pd.read_csv(directory, dtype=dtype, engine=csv_engine())
 
-    def csv_2DArray(self, directory):
+    def csv_chunks(self, directory, chunk_size=100000, dtype=np.float64):
         '''
-        Read csv file into a pandas data frame
+        Read csv file chunk wise, so only one chunk is held in memory at a time. All columns
+        are parsed as dtype instead of inferring their types, with the streaming pyarrow parser if available
 
         :param directory: directory of csv file
-        :return: panda data frame of csv file
+        :param chunk_size: amount of rows per chunk
+        :param dtype: type of all columns
+        :return: iterator over panda data frames of the csv file
+        '''
+        if csv_engine() == 'pyarrow':
+            return self._arrow_csv_chunks(directory, chunk_size, dtype)
+        return pd.read_csv(directory, chunksize=chunk_size, dtype=dtype)
+
+    def _arrow_csv_chunks(self, directory, chunk_size, dtype):
+        '''
+        Read csv file chunk wise with the streaming pyarrow parser, its blocks are regrouped into chunks of chunk_size rows
+
+        :param directory: directory of csv file
+        :param chunk_size: amount of rows per chunk
+        :param dtype: type of all columns
+        :return: iterator over panda data frames of the csv file
+        '''
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        # Declare the type of every column of the header
+        with open(directory, newline='') as file:
+            column_names = next(csv.reader(file), [])
+        column_type = pa.from_numpy_dtype(np.dtype(dtype))
+        reader = pa_csv.open_csv(directory, convert_options=pa_csv.ConvertOptions(
+            column_types={name: column_type for name in column_names}))
+
+        batches = []
+        rows = 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+
+            # Hand out full chunks, the rest waits for the next block
+            while rows >= chunk_size:
+                table = pa.Table.from_batches(batches, schema=reader.schema)
+                yield table.slice(0, chunk_size).to_pandas()
+                rest = table.slice(chunk_size)
+                batches = rest.to_batches()
+                rows = rest.num_rows
+
+        if rows > 0:
+            yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+    def fingerprint_file(self, directory, extra=''):
+        '''
+        Calculate the content hash of a file, an unchanged file (same size and modification time)
+        is only read once per manager
+
+        :param directory: directory of the file
+        :param extra: additional text hashed after the content (e.g. parameters the import depends on)
+        :return: sha256 hex digest of the file content
+        '''
+        status = os.stat(directory)
+        key = (os.path.abspath(directory), extra)
+        cached = self._file_hashes.get(key)
+        if cached is not None and cached[:2] == (status.st_size, status.st_mtime_ns):
+            return cached[2]
+
+        file_hash = hashlib.sha256()
+        with open(directory, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                file_hash.update(block)
+        file_hash.update(extra.encode())
+
+        self._file_hashes[key] = (status.st_size, status.st_mtime_ns, file_hash.hexdigest())
+        return file_hash.hexdigest()
+
+    def get_import_fingerprint(self, source):
+        '''
+        Get the recorded fingerprint of an imported source
+
+        :param source: name of the source (e.g. path of the csv file)
+        :return: dict with table, hash, row count and schema or None if never imported
+        '''
+        connection = self._connect()
+        try:
+            row = connection.exec_driver_sql(
+                "SELECT `Table name`, `Hash`, `Row count`, `Schema` FROM import_db WHERE `Source` = ?", (source,)).fetchone()
+        finally:
+            self._release(connection)
+
+        if row is None:
+            return None
+        return {'table': row[0], 'hash': row[1], 'row_count': row[2], 'schema': row[3]}
+
+    def record_import_fingerprint(self, source, table_name, file_hash, row_count, schema, connection=None):
+        '''
+        Record the fingerprint of an imported source
+
+        :param source: name of the source (e.g. path of the csv file)
+        :param table_name: table the source was imported into
+        :param file_hash: content hash of the source
+        :param row_count: amount of rows of the source
+        :param schema: column names of the source
+        :param connection: open connection to record inside its transaction, otherwise an own transaction is used
+        :return: BOOL if successfull
+        '''
+        sql = "INSERT OR REPLACE INTO import_db (`Source`, `Table name`, `Hash`, `Row count`, `Schema`) VALUES (?, ?, ?, ?, ?)"
+        params = (source, table_name, file_hash, int(row_count), schema)
+
+        # Part of the callers transaction
+        if connection is not None:
+            connection.exec_driver_sql(sql, params)
+            return True
+
+        connection = self._connect()
+        try:
+            connection.exec_driver_sql(sql, params)
+            connection.commit()
+            return True
+
+        except Exception as e:
+            print(f"Error while INSERT operation in import_db: {e}")
+            connection.rollback()
+            return False
+
+        finally:
+            # Close connection
+            self._release(connection)
+
+    def clear_table(self, table_name):
+        '''
+        Delete all records of a table together with the import fingerprints of the table
+
+        :param table_name: name of the table to clear
+        :return: BOOL if successfull
         '''
-        return pd.read_csv(directory)
+        connection = self._connect()
+        try:
+            connection.exec_driver_sql(f"DELETE FROM {table_name}")
+            connection.exec_driver_sql("DELETE FROM import_db WHERE `Table name` = ?", (table_name,))
+            connection.commit()
+            return True
+
+        except Exception as e:
+            print(f"Error while DELETE operation in {table_name}: {e}")
+            connection.rollback()
+            return False
+
+        finally:
+            # Close connection
+            self._release(connection)
+
+    def ideal_snapshot_path(self, directory, cache_dir=None, dtype=np.float64):
+        '''
+        Get the binary snapshot (.npy) of the ideal matrix of an ideal csv, the snapshot is keyed by
+        the path and the content hash of the csv and only created if it does not exist yet. Creating
+        it deletes the snapshots of older contents of the same csv
+
+        :param directory: directory of ideal csv file
+        :param cache_dir: directory of the snapshots, next to the database if None
+        :param dtype: np.float64 or np.float32 (compact snapshot of half the size)
+        :return: path of the snapshot
+        '''
+        dtype = np.dtype(dtype)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.db_path)), 'ideal_cache')
+        suffix = '' if dtype == np.float64 else f'_{dtype.name}'
+        source_key = hashlib.sha256(os.path.abspath(directory).encode()).hexdigest()[:16]
+        file_hash = self.fingerprint_file(directory)
+        snapshot_path = os.path.join(cache_dir, f'ideal_{source_key}_{file_hash}{suffix}.npy')
+
+        if not os.path.exists(snapshot_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            ideal_df = self.csv_2DArray(directory)
+            ideal_matrix = np.ascontiguousarray(ideal_df.loc[:, 'x':'y50'].to_numpy(dtype=dtype))
+
+            # Write to a temporary file first, so other processes never open a half written snapshot
+            temp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as file:
+                np.save(file, ideal_matrix)
+            os.replace(temp_path, snapshot_path)
+
+            # Snapshots of older contents of this csv, of every precision, are stale
+            for stale_path in glob.glob(os.path.join(cache_dir, f'ideal_{source_key}_*.npy')):
+                if not os.path.basename(stale_path).startswith(f'ideal_{source_key}_{file_hash}'):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        # Still opened by another process (Windows), removed by a later run
+                        pass
+
+        return snapshot_path
+
+    def load_ideal_snapshot(self, directory, cache_dir=None, dtype=np.float64):
+        '''
+        Load the ideal matrix of an ideal csv from its memory mapped binary snapshot, processes
+        opening the same snapshot share its pages instead of holding a private copy
+
+        :param directory: directory of ideal csv file
+        :param cache_dir: directory of the snapshots, next to the database if None
+        :param dtype: np.float64 or np.float32 (compact snapshot of half the size)
+        :return: panda data frame with the columns of ideal_db backed by the read only memory map
+        '''
+        ideal_matrix = np.load(self.ideal_snapshot_path(directory, cache_dir, dtype), mmap_mode='r')
+        return pd.DataFrame(ideal_matrix, columns=TABLE_COLUMNS['ideal_db'], copy=False)
+
+    def get_fit_result(self, key):
+        '''
+        Get a memoized fit result and mark it as recently used
+
+        :param key: fingerprint of the fit input
+        :return: stored result text or None on a cache miss
+        '''
+        connection = self._connect()
+        try:
+            row = connection.exec_driver_sql("SELECT `Result` FROM fit_cache_db WHERE `Key` = ?", (key,)).fetchone()
+            if row is not None:
+                connection.exec_driver_sql("UPDATE fit_cache_db SET `Last used` = ? WHERE `Key` = ?", (time.time(), key))
+                connection.commit()
+            return None if row is None else row[0]
+
+        except Exception as e:
+            print(f"Error while SELECT operation in fit_cache_db: {e}")
+            connection.rollback()
+            return None
+
+        finally:
+            self._release(connection)
+
+    def put_fit_result(self, key, result, max_entries=100):
+        '''
+        Memoize a fit result, the least recently used results beyond max_entries are evicted
+
+        :param key: fingerprint of the fit input
+        :param result: result text to store
+        :param max_entries: amount of results kept
+        :return: BOOL if successfull
+        '''
+        connection = self._connect()
+        try:
+            now = time.time()
+            connection.exec_driver_sql(
+                "INSERT OR REPLACE INTO fit_cache_db (`Key`, `Result`, `Created`, `Last used`) VALUES (?, ?, ?, ?)",
+                (key, result, now, now))
+
+            # Evict the least recently used results
+            connection.exec_driver_sql(
+                "DELETE FROM fit_cache_db WHERE `Key` NOT IN (SELECT `Key` FROM fit_cache_db ORDER BY `Last used` DESC LIMIT ?)",
+                (max_entries,))
+            connection.commit()
+            return True
+
+        except Exception as e:
+            print(f"Error while INSERT operation in fit_cache_db: {e}")
+            connection.rollback()
+            return False
+
+        finally:
+            self._release(connection)
 
     def import_trainCSV(self, directory):
         '''
-        Import the train data from the train.csv into the database
+        Import the train data from the train.csv into the database. An unchanged csv is skipped,
+        a changed csv only writes its new or modified rows
         
         :param directory: directory of csv file
         :return: size of successfull added records
         '''
-        counter = 0
-        train_df = self.csv_2DArray(directory)
-        for ind in train_df.index:
-            if self.trainDB_add_record(train_df['x'][ind], train_df['y1'][ind], train_df['y2'][ind], train_df['y3'][ind], train_df['y4'][ind]): 
-                counter += 1
-        
-        # Return the amount of records that has been added
-        return counter
+        return self._import_source(directory, 'train_db', 'y4')
 
     def import_idealCSV(self, directory):
         '''
-        Import the ideal data from the ideal.csv into the database
+        Import the ideal data from the ideal.csv into the database. An unchanged csv is skipped,
+        a changed csv only writes its new or modified rows
 
         :param directory: directory of csv file
         :return: size of successfull added records
         '''
+        return self._import_source(directory, 'ideal_db', 'y50')
+
+    def _import_source(self, directory, table_name, last_column):
+        '''
+        Import the columns x to last_column of a csv into a table, controlled by the recorded fingerprint of the csv
+
+        :param directory: directory of csv file
+        :param table_name: name of the table to import into
+        :param last_column: last csv column to import
+        :return: size of successfull added or updated records
+        '''
+        source = os.path.abspath(directory)
+        file_hash = self.fingerprint_file(directory)
+        previous = self.get_import_fingerprint(source)
+
+        # Skip unchanged sources entirely
+        if previous is not None and previous['hash'] == file_hash and previous['table'] == table_name:
+            print(f"Skipped import of {directory} into {table_name}, source is unchanged")
+            return 0
+
+        # Small files are imported in one transaction, huge files chunk wise
+        if self.IMPORT_CHUNK_ROWS is None or os.path.getsize(directory) < self.IMPORT_CHUNKED_FROM_BYTES:
+            data_frame = self.csv_2DArray(directory).loc[:, 'x':last_column]
+            fingerprint = {
+                'source': source,
+                'hash': file_hash,
+                'row_count': len(data_frame),
+                'schema': ','.join(data_frame.columns),
+            }
+
+            # A changed source only updates rows which differ from the stored ones
+            return self.bulk_import_dataframe(table_name, data_frame, upsert=previous is not None, fingerprint=fingerprint)
+
         counter = 0
-        ideal_df = self.csv_2DArray(directory)
-        for ind in ideal_df.index:
-            x_value = ideal_df['x'][ind]
-            y_values = ideal_df.loc[ind, 'y1':'y50'].values
-            # on success increase the counter by one
-            if self.idealDB_add_record(x_value, y_values): 
-                counter += 1
-        
-        # Return the amount of records that has been added
+        row_count = 0
+        schema = ''
+        try:
+            for chunk in self.csv_chunks(directory, self.IMPORT_CHUNK_ROWS):
+                data_frame = chunk.loc[:, 'x':last_column]
+                counter += self.bulk_import_dataframe(table_name, data_frame, upsert=previous is not None, raise_errors=True)
+                row_count += len(data_frame)
+                schema = ','.join(data_frame.columns)
+
+        except Exception as e:
+            # Without a fingerprint the import is repeated on the next run, the stored chunks are upserted again
+            print(f"Error while chunked import of {directory} into {table_name}, stopped after {row_count} rows: {e}")
+            return 0
+
+        # Recorded only after every chunk was imported
+        self.record_import_fingerprint(source, table_name, file_hash, row_count, schema)
         return counter
 
+    def bulk_import_dataframe(self, table_name, data_frame:pd.DataFrame, chunk_size=50000, upsert=False, fingerprint=None, raise_errors=False):
+        '''
+        Import a whole data frame into a table with one prepared statement inside one transaction.
+        The data frame columns are matched by position to the table columns. Rows that can not be
+        inserted (e.g. duplicate X primary keys) are skipped and reported in one summary
+
+        :param table_name: name of the table to import into
+        :param data_frame: data frame with one column per table column
+        :param chunk_size: amount of rows handed to executemany at once
+        :param upsert: if True rows with an existing X replace the stored values if they differ, instead of being skipped
+        :param fingerprint: dict with source, hash, row_count and schema recorded in the same transaction
+        :param raise_errors: if True a failed import is raised after the rollback, instead of returning 0
+        :return: size of successfull added (or updated) records
+        '''
+        columns = TABLE_COLUMNS[table_name]
+        if len(data_frame.columns) != len(columns):
+            raise ValueError(f"Expected {len(columns)} columns for {table_name}, got {len(data_frame.columns)}")
+
+        # Prepared statement, a changed source only writes new or modified rows, otherwise rows violating a constraint are skipped
+        sql = insert_sql(table_name, 'upsert' if upsert else 'ignore')
+
+        counter = 0
+        connection = self._connect()
+        try:
+            # Execute SQL statement chunk wise, all chunks share one transaction
+            for start in range(0, len(data_frame), chunk_size):
+                chunk = data_frame.iloc[start:start + chunk_size]
+                rows = list(chunk.astype(float).itertuples(index=False, name=None))
+                result = connection.exec_driver_sql(sql, rows)
+                counter += result.rowcount
+
+            # Record the fingerprint of the imported source
+            if fingerprint is not None:
+                self.record_import_fingerprint(fingerprint['source'], table_name, fingerprint['hash'],
+                                               fingerprint['row_count'], fingerprint['schema'], connection)
+            connection.commit()
+
+        except Exception as e:
+            print(f"Error while bulk INSERT operation in {table_name}: {e}")
+            connection.rollback()
+            if raise_errors:
+                raise
+            return 0
+
+        finally:
+            # Close connection
+            self._release(connection)
+
+        # Report all rejected or unchanged rows in one summary
+        skipped = len(data_frame) - counter
+        if skipped > 0 and upsert:
+            print(f"Kept {skipped} of {len(data_frame)} unchanged rows while bulk UPSERT operation in {table_name}")
+        elif skipped > 0:
+            print(f"Skipped {skipped} of {len(data_frame)} rows while bulk INSERT operation in {table_name} (duplicate or invalid X primary key)")
+
+        # Return the amount of records that has been added
+        return counter
 
     def trainDB_add_record(self, x, y1, y2, y3, y4):
         '''
@@ -91,26 +676,10 @@ class DatabaseManager:
         :param directory: directory of csv file
         :return: BOOL if successfull
         '''
-        connection = self.db_engine.connect()
+        connection = self._connect()
         try:
-            # Creation SQL statement with placeholder
-            sql = db.text("""
-                INSERT INTO train_db 
-                (`X`, `Y1 (training func)`, `Y2 (training func)`, `Y3 (training func)`, `Y4 (training func)`)
-                VALUES (:x, :y1, :y2, :y3, :y4)
-            """)
-
-            # Parameter with input data
-            params = {
-                'x': x,
-                'y1': y1,
-                'y2': y2,
-                'y3': y3,
-                'y4': y4
-            }
-
-            # Execute SQL statement
-            connection.execute(sql, params)
+            # Execute the prepared SQL statement
+            connection.exec_driver_sql(insert_sql('train_db'), (x, y1, y2, y3, y4))
             connection.commit()
             return True
 
@@ -121,7 +690,7 @@ class DatabaseManager:
 
         finally:
             # Close connection
-            connection.close()
+            self._release(connection)
 
        
         
@@ -134,25 +703,10 @@ class DatabaseManager:
         :param directory: directory of csv file
         :return: BOOL if successfull
         '''
-        connection = self.db_engine.connect()
+        connection = self._connect()
         try:
-            # Create column name string for SQL statement
-            columns = ['`X`'] + [f'`Y{i} (ideal func)`' for i in range(1, 51)]
-            column_string = ', '.join(columns)
-
-            # Create value placeholder
-            value_placeholders = [':x'] + [f':y{i}' for i in range(1, 51)]
-            value_string = ', '.join(value_placeholders)
-
-            # Creation of SQL statement with placeholder
-            sql = f"""INSERT INTO ideal_db ({column_string}) VALUES ({value_string})"""
-
-            # Parameter with input data
-            params = {'x': x}
-            params.update({f'y{i+1}': y for i, y in enumerate(y_values)})
-
-            # Execute SQL statement
-            connection.execute(db.text(sql), params)
+            # Execute the prepared SQL statement
+            connection.exec_driver_sql(insert_sql('ideal_db'), (x, *y_values))
             connection.commit()
             return True
 
@@ -163,7 +717,7 @@ class DatabaseManager:
 
         finally:
             # Close connections
-            connection.close()
+            self._release(connection)
 
     
     def testDB_add_record(self, x_test, y_test, delta_y_test, no_ideal_func):
@@ -176,25 +730,10 @@ class DatabaseManager:
         :param no_ideal_func: No. of ideal func value
         :return: BOOL if successfull
         '''
-        connection = self.db_engine.connect()
+        connection = self._connect()
         try:
-            # Creation of SQL statement with placeholder
-            sql = db.text("""
-                INSERT INTO test_db 
-                (`X (test func)`, `Y (test func)`, `Delta Y (test func)`, `No. of ideal func`)
-                VALUES (:x_test, :y_test, :delta_y_test, :no_ideal_func)
-            """)
-
-            # Parameter with input data
-            params = {
-                'x_test': x_test,
-                'y_test': y_test,
-                'delta_y_test': delta_y_test,
-                'no_ideal_func': no_ideal_func
-            }
-
-            # Execute SQL statement
-            connection.execute(sql, params)
+            # Execute the prepared SQL statement
+            connection.exec_driver_sql(insert_sql('test_db'), (x_test, y_test, delta_y_test, no_ideal_func))
             connection.commit()
             return True
 
@@ -205,7 +744,52 @@ class DatabaseManager:
 
         finally:
             # Close connections
-            connection.close()
+            self._release(connection)
+
+    def testDB_add_records(self, x_test, y_test, delta_y_test, no_ideal_func, table_name='test_db'):
+        '''
+        Add many records to the test table in the database inside one transaction,
+        missing deviations and function numbers (None/NaN) are stored as NULL
+
+        :param x_test: array of X values
+        :param y_test: array of Y (test func) values
+        :param delta_y_test: array of Delta Y (test func) values
+        :param no_ideal_func: array of No. of ideal func values
+        :param table_name: 'test_db' or 'service_db' (results of the classification service)
+        :return: size of successfull added records
+        '''
+        # Convert NaN into None so it will be stored as NULL
+        columns = [pd.Series(values, dtype=float).astype(object) for values in (x_test, y_test, delta_y_test, no_ideal_func)]
+        columns = [column.where(column.notna(), None) for column in columns]
+        rows = list(zip(*columns))
+        if len(rows) == 0:
+            return 0
+
+        connection = self._connect()
+        try:
+            # Execute SQL statement for all rows at once
+            result = connection.exec_driver_sql(insert_sql(table_name), rows)
+            connection.commit()
+            return result.rowcount
+
+        except Exception as e:
+            print(f"Error while bulk INSERT operation in {table_name}: {e}")
+            connection.rollback()
+            return 0
+
+        finally:
+            # Close connections
+            self._release(connection)
+
+    def create_test_writer(self, batch_size=10000, table_name='test_db'):
+        '''
+        Create a buffered writer for the test table
+
+        :param batch_size: amount of buffered records which triggers a flush
+        :param table_name: 'test_db' or 'service_db' (results of the classification service)
+        :return: TestResultWriter of this database
+        '''
+        return TestResultWriter(self, batch_size, table_name)
     
 
     def createDatabase(self):
@@ -215,7 +799,7 @@ class DatabaseManager:
         :return: true if successfull
         '''
         # Get connection object
-        connection = self.db_engine.connect()
+        connection = self._connect()
 
         try:
             # Get meta data object
@@ -258,9 +842,50 @@ class DatabaseManager:
                 db.Column('No. of ideal func', db.DOUBLE_PRECISION)
             )
 
+            # Create service_db table with the results of the classification service, kept apart from the test csv results
+            db.Table(
+                'service_db',
+                meta_data,
+                db.Column('Primary Key', db.DOUBLE_PRECISION, primary_key=True, autoincrement=True, nullable=True),
+                db.Column('X (test func)', db.DOUBLE_PRECISION),
+                db.Column('Y (test func)', db.DOUBLE_PRECISION),
+                db.Column('Delta Y (test func)', db.DOUBLE_PRECISION),
+                db.Column('No. of ideal func', db.DOUBLE_PRECISION)
+            )
+
+            # Indexes for the filters of query_test_results
+            db.Index('ix_test_db_func_x', test_db.c['No. of ideal func'], test_db.c['X (test func)'])
+            db.Index('ix_test_db_x', test_db.c['X (test func)'])
+            db.Index('ix_test_db_delta', test_db.c['Delta Y (test func)'])
+
+            # Create import_db table with the fingerprint of every imported source
+            import_db = db.Table(
+                'import_db',
+                meta_data,
+                db.Column('Source', db.String, primary_key=True),
+                db.Column('Table name', db.String),
+                db.Column('Hash', db.String),
+                db.Column('Row count', db.Integer),
+                db.Column('Schema', db.String)
+            )
+
+            # Create fit_cache_db table with the memoized fit results
+            fit_cache_db = db.Table(
+                'fit_cache_db',
+                meta_data,
+                db.Column('Key', db.String, primary_key=True),
+                db.Column('Result', db.String),
+                db.Column('Created', db.DOUBLE_PRECISION),
+                db.Column('Last used', db.DOUBLE_PRECISION)
+            )
+
             # Create train_db table and stores the information in metadata
             meta_data.create_all(self.db_engine)
 
+            # Add the indexes to test tables of older databases as well
+            for index in test_db.indexes:
+                index.create(self.db_engine, checkfirst=True)
+
             # On success return True
             return True
 
@@ -271,4 +896,73 @@ class DatabaseManager:
 
         finally:
             # Close connection
-            connection.close()
\ No newline at end of file
+            self._release(connection)
+
+
+class TestResultWriter:
+    def __init__(self, db_manager:DatabaseManager, batch_size=10000, table_name='test_db'):
+        '''
+        Buffers classification results and writes them batch wise into the test table
+
+        :param db_manager: database manager to write with
+        :param batch_size: amount of buffered records which triggers a flush
+        :param table_name: 'test_db' or 'service_db' (results of the classification service)
+        '''
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.table_name = table_name
+        self.written = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Write the remaining records when leaving the with block
+        self.flush()
+
+    def add(self, x_test, y_test, delta_y_test, no_ideal_func):
+        '''
+        Add one or many results (scalars or arrays of equal length) to the buffer
+
+        :param x_test: X value(s)
+        :param y_test: Y (test func) value(s)
+        :param delta_y_test: Delta Y (test func) value(s), None/NaN if unmatched
+        :param no_ideal_func: No. of ideal func value(s), None/NaN if unmatched
+        '''
+        columns = [pd.Series(np.atleast_1d(np.asarray(values, dtype=float))) for values in (x_test, y_test, delta_y_test, no_ideal_func)]
+        if len({len(column) for column in columns}) != 1:
+            raise ValueError("All result arrays need the same length")
+
+        self._buffer.append(columns)
+        self._buffered += len(columns[0])
+
+        # Flush if the buffer reached its threshold
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def add_dataframe(self, data_frame:pd.DataFrame):
+        '''
+        Add results from a data frame with the columns (x, y, delta, func_id) in this order
+
+        :param data_frame: results to add
+        '''
+        self.add(*(data_frame.iloc[:, i].values for i in range(4)))
+
+    def flush(self):
+        '''
+        Write all buffered results inside one transaction into the test table
+
+        :return: size of successfull added records
+        '''
+        if self._buffered == 0:
+            return 0
+
+        columns = [pd.concat([entry[i] for entry in self._buffer], ignore_index=True) for i in range(4)]
+        self._buffer = []
+        self._buffered = 0
+
+        counter = self.db_manager.testDB_add_records(*columns, table_name=self.table_name)
+        self.written += counter
+        return counter
@@ -1,53 +1,98 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+
+# Visible x and y range of the plot
+PLOT_LIMITS = (-20, 20)
 
 class VisualManger:
 
-    def __init__(self, df_train, df_ideal, df_test):
+    def __init__(self, df_train, df_ideal, df_test, large_data=False, raster_size=(750, 500), curve_points=2000):
         """
         Saves localy need data fields
 
         :param df_train: train data
         :param df_ideal: ideal data
         :param df_test: test data
+        :param large_data: if True points are drawn as density raster and curves are decimated,
+                           so render time and file size do not grow with the data size
+        :param raster_size: (width, height) bins of the density raster
+        :param curve_points: max points per drawn curve
         """
         self.dataFrame_train = df_train
         self.dataFrame_ideal = df_ideal
         self.dataFrame_test = df_test
+        self.large_data = large_data
+        self.raster_size = raster_size
+        self.curve_points = curve_points
 
-    def visualize_data_and_deviations(self, func_x_max_dev:pd.DataFrame, function_colors):
+    def visualize_data_and_deviations(self, func_x_max_dev:pd.DataFrame, function_colors, output_path=None, dpi=100):
         """
         Visualisation of the chosen and unchosen functions, all train data, all deviation zones 
         and test data with its matched function color (if it matched)
 
         :param func_x_max_dev: the chosen functions matched with there individual deviation
         :param function_colors: color for the functions, last color for unmatchend test data and unchosen functions
+        :param output_path: if set the plot is rendered headless into this file (format by extension, e.g. png, svg, pdf) instead of shown in a window
+        :param dpi: resolution of raster output files
+        :return: output_path
         """
+        # matplotlib is only loaded when something is plotted
+        if output_path is None:
+            import matplotlib.pyplot as plt
+
+            # Plot aspect ratio
+            figure = plt.figure(figsize=(15, 10))
+            self._draw(figure, func_x_max_dev, function_colors)
+            plt.show()
+            return None
+
+        # Figure without pyplot, it needs no display and is freed with its last reference
+        from matplotlib.figure import Figure
+        figure = Figure(figsize=(15, 10))
+        self._draw(figure, func_x_max_dev, function_colors)
+        figure.savefig(output_path, dpi=dpi)
+        return output_path
+
+    @staticmethod
+    def render_batch(jobs, dpi=100):
+        """
+        Render many plots headless into files, one figure at a time
+
+        :param jobs: iterable of (VisualManger, func_x_max_dev, function_colors, output_path)
+        :param dpi: resolution of raster output files
+        :return: list of the written files
+        """
+        return [visual_manager.visualize_data_and_deviations(func_x_max_dev, function_colors, output_path, dpi)
+                for visual_manager, func_x_max_dev, function_colors, output_path in jobs]
+
+    def _draw(self, figure, func_x_max_dev:pd.DataFrame, function_colors):
+        """
+        Draw the whole visualisation into a figure
+
+        :param figure: figure to draw into
+        :param func_x_max_dev: the chosen functions matched with there individual deviation
+        :param function_colors: color for the functions, last color for unmatchend test data and unchosen functions
+        """
+        axes = figure.add_subplot()
 
-        # Plot aspect ratio
-        plt.figure(figsize=(15, 10))
-    
         # Plot ideal functions
-        self._plot_ideal_functions(func_x_max_dev, function_colors)
+        self._plot_ideal_functions(axes, func_x_max_dev, function_colors)
     
         # Plot training data
-        self._plot_training_data()
+        self._plot_training_data(axes)
     
         # Plot test data
-        self._plot_test_data(func_x_max_dev['func_id'], function_colors)
+        self._plot_test_data(axes, func_x_max_dev['func_id'], function_colors)
     
         # Visualize everything
-        plt.xlabel('X')
-        plt.ylabel('Y')
-        plt.title('Data Visualization with Deviations')
-        plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
-        plt.grid(True, alpha=0.3)
-        plt.xlim(-20, 20)
-        plt.ylim(-20, 20)
-        plt.tight_layout()
-        plt.show()
+        axes.set_xlabel('X')
+        axes.set_ylabel('Y')
+        axes.set_title('Data Visualization with Deviations')
+        axes.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+        axes.grid(True, alpha=0.3)
+        axes.set_xlim(*PLOT_LIMITS)
+        axes.set_ylim(*PLOT_LIMITS)
+        figure.tight_layout()
 
     def darken_color(self, hex_color, factor):
         """
@@ -59,6 +104,8 @@ class VisualManger:
         :return: darker color
         """
 
+        import matplotlib.colors as mcolors
+
         # Convert hex to rgb
         rgb = mcolors.hex2color(hex_color)
         
@@ -71,10 +118,11 @@ class VisualManger:
         return darkened_hex
     
 
-    def _plot_function_with_derivativ_area(self, x,y, max_deviation, function_color, text):
+    def _plot_function_with_derivativ_area(self, axes, x,y, max_deviation, function_color, text):
         """
         Plotting a function by x and y coordinates + an deviation area around it set by max_deviation
 
+        :param axes: axes to plot into
         :param x: x values of the function
         :param y: y values of the function
         :param max_deviation: size of deviation area around the function (for one side)
@@ -104,81 +152,139 @@ class VisualManger:
         x_fill = np.concatenate([x_upper, x_lower[::-1]])
         y_fill = np.concatenate([y_upper, y_lower[::-1]])
     
-        plt.plot(x, y, label=text, color= function_color, linewidth=2)
-        plt.fill(x_fill, y_fill, color= function_color, alpha=0.4)
+        axes.plot(x, y, label=text, color= function_color, linewidth=2)
+        axes.fill(x_fill, y_fill, color= function_color, alpha=0.4)
     
-    def _plot_training_data(self):
+    def _plot_training_data(self, axes):
         """
         Scatters all the trainings data in gray and low alpha
+
+        :param axes: axes to plot into
         """
         # Boolean helper variable to only print the label one time
         label_printed = False
         # Go though the whole dataFrame_train and scatter each dot in gray 
-        for col in self.dataFrame_train.columns[1:]:  # Assuming first column is 'X'
+        # The first column is x, read by position so csv frames with a lowercase x work too
+        x = self.dataFrame_train.iloc[:, 0]
+        for col in self.dataFrame_train.columns[1:]:
             if label_printed == True:
-                plt.scatter(self.dataFrame_train['X'], self.dataFrame_train[col], alpha=0.2, s=20, c='gray')
+                self._scatter(axes, x, self.dataFrame_train[col], 'gray', alpha=0.2, size=20)
             else:    
-                plt.scatter(self.dataFrame_train['X'], self.dataFrame_train[col], alpha=0.2, label=f'Training data', s=20, c='gray')
+                self._scatter(axes, x, self.dataFrame_train[col], 'gray', alpha=0.2, size=20, label=f'Training data')
                 label_printed = True
 
     
-    def _plot_test_data(self, chosen_functions, function_colors):
+    def _plot_test_data(self, axes, chosen_functions, function_colors):
         """
         Scatter the matched and unmatched test data from the chosen functions, unmatched test data will be displayed in gray
 
+        :param axes: axes to plot into
         :param chosen_functions: the chosen function from the ideal function data set in order of the function_colors param
         :param function_colors: the function colors in order of the chosen_function param
         """
+        x = self.dataFrame_test['X (test func)'].to_numpy()
+        y = self.dataFrame_test['Y (test func)'].to_numpy()
+        func_nums = self.dataFrame_test['No. of ideal func'].to_numpy(dtype=float)
 
-        # 5 lists for (x, y) pairs
-        array_xy = [[] for _ in range(len(chosen_functions)+1)]  
-    
-        for _, row in self.dataFrame_test.iterrows():
-            x, y = row['X (test func)'], row['Y (test func)']
-            func_num = row['No. of ideal func']
-            
-            # Filter for chosen and unchosen test data
-            if pd.notna(func_num):
-                if func_num in chosen_functions.values:
-                    index = chosen_functions[chosen_functions == func_num].index[0]
-                    array_xy[index].append((x,y))         
-            else:
-                array_xy[4].append((x,y))  
-                
-        # Scatter matched test data
-        for index in range(len(array_xy)-1):
-            plt.scatter([pair[0] for pair in array_xy[index]], 
-                        [pair[1] for pair in array_xy[index]], 
-                        color= self.darken_color(function_colors[index],0.95), 
-                        label='Matched Test Data', 
-                        s=30)
+        # Scatter matched test data, grouped by its function
+        for index, func_id in enumerate(chosen_functions):
+            matched = func_nums == func_id
+            self._scatter(axes, x[matched], y[matched], 
+                          self.darken_color(function_colors[index],0.95), 
+                          label='Matched Test Data', 
+                          size=30)
         
         # Scatter unmatched test data
-        plt.scatter([pair[0] for pair in array_xy[len(array_xy)-1]], 
-                    [pair[1] for pair in array_xy[len(array_xy)-1]], 
-                    color='gray', 
-                    label='Unmatched Test Data', 
-                    s=30)
+        unmatched = np.isnan(func_nums)
+        self._scatter(axes, x[unmatched], y[unmatched], 
+                      'gray', 
+                      label='Unmatched Test Data', 
+                      size=30)
     
-    def _plot_ideal_functions(self, func_x_max_dev:pd.DataFrame, function_colors):
+    def _plot_ideal_functions(self, axes, func_x_max_dev:pd.DataFrame, function_colors):
         """
         Scatter the matched and unmatched test data from the chosen functions, unmatched test data will be displayed in gray
 
+        :param axes: axes to plot into
         :param func_x_max_dev: the chosen functions matched with there individual deviation
         :param function_colors: the function colors in order of the chosen function from func_x_max_dev param
         """
         # Plot ideal functions
-        x = self.dataFrame_ideal['X']
+        x = self.dataFrame_ideal.iloc[:, 0].to_numpy()
         for i in range(1, len(self.dataFrame_ideal.columns)):  # Start from column index 1
-            y = self.dataFrame_ideal.iloc[np.searchsorted(self.dataFrame_ideal['X'], x), i]
+            y = self.dataFrame_ideal.iloc[:, i].to_numpy()
+            x_curve, y_curve = self._decimate(x, y)
             
             # Find the chosen functions
             if i in func_x_max_dev['func_id'].values:
                 index = func_x_max_dev[func_x_max_dev['func_id'] == i].index[0]
-                self._plot_function_with_derivativ_area(x,y,
+                self._plot_function_with_derivativ_area(axes, x_curve,y_curve,
                                                         func_x_max_dev['max_div'].at[index], 
                                                         function_colors[index], 
                                                         f'Chosen function {i}')
             # Unchosen function are displayed in gray
             else:
-                plt.plot(x, y, color='gray', linewidth=1, alpha=0.2)
\ No newline at end of file
+                axes.plot(x_curve, y_curve, color='gray', linewidth=1, alpha=0.2)
+
+    def _scatter(self, axes, x, y, color, alpha=1.0, size=20, label=None):
+        """
+        Scatter points, in large data mode the points are binned into a density raster instead
+
+        :param axes: axes to plot into
+        :param x: x values of the points
+        :param y: y values of the points
+        :param color: color of the points
+        :param alpha: opacity of the points (of the least dense raster bins)
+        :param size: marker size
+        :param label: text to the explanation fiel on the side
+        """
+        if not self.large_data:
+            axes.scatter(x, y, alpha=alpha, s=size, color=color, label=label)
+            return
+
+        import matplotlib.colors as mcolors
+
+        # Count the points per raster bin of the visible area
+        counts, _, _ = np.histogram2d(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      bins=self.raster_size, range=[PLOT_LIMITS, PLOT_LIMITS])
+        counts = counts.T
+
+        # Colored bins, denser bins are more opaque
+        image = np.zeros(counts.shape + (4,))
+        image[..., :3] = mcolors.to_rgb(color)
+        if counts.max() > 0:
+            density = np.log1p(counts) / np.log1p(counts.max())
+            image[..., 3] = np.where(counts > 0, alpha + (1 - alpha) * density, 0)
+
+        axes.imshow(image, extent=(*PLOT_LIMITS, *PLOT_LIMITS), origin='lower', aspect='auto', interpolation='nearest')
+
+        # Invisible marker for the explanation field
+        axes.scatter([], [], alpha=alpha, s=size, color=color, label=label)
+
+    def _decimate(self, x, y):
+        """
+        Reduce a curve to curve_points points in large data mode, the min and max point of each
+        bin are kept, so peaks and the shape of the curve survive
+
+        :param x: x values of the curve
+        :param y: y values of the curve
+        :return: x and y values to draw
+        """
+        bin_count = self.curve_points // 2
+        if not self.large_data or len(x) <= self.curve_points or bin_count == 0:
+            return x, y
+
+        # Equally sized bins, the last one is padded with its last point
+        bin_size = -(-len(x) // bin_count)
+        padded = np.pad(y, (0, bin_size * bin_count - len(y)), mode='edge').reshape(bin_count, bin_size)
+        offsets = np.arange(bin_count) * bin_size
+
+        # Bins without any value keep one NaN point, so gaps of the curve stay gaps
+        empty = np.isnan(padded).all(axis=1)
+        padded = padded[~empty]
+
+        # Min and max point of every bin in the original order
+        indexes = np.concatenate([offsets[~empty] + np.nanargmin(padded, axis=1), offsets[~empty] + np.nanargmax(padded, axis=1),
+                                  offsets[empty]])
+        indexes = np.unique(np.minimum(indexes, len(x) - 1))
+        return x[indexes], y[indexes]
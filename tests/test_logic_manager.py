@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+from src.logic_manager import LogicManager
+
+def direct_best_fit(y_train, y_ideal):
+    '''
+    Best fitting ideal function of every train function from the direct sums of squared errors
+    '''
+    return np.array([np.argmin(((y_ideal - y_train[:, [column]]) ** 2).sum(axis=0)) + 1
+                     for column in range(y_train.shape[1])])
+
+def test_best_fit_functions_large_offset():
+    # Large curves with small gaps between the ideal functions cancel in ||t||² - 2·tᵀY + ||Y||²
+    for seed in range(20):
+        rng = np.random.default_rng(seed)
+        x = np.arange(100000, dtype=np.float64)
+        y_ideal = 1e4 + rng.normal(0, 1, (len(x), 1)) + 1e-3 * np.arange(20)[np.newaxis, :]
+        y_train = y_ideal[:, rng.integers(0, 20, 3)] + rng.normal(0, 1e-3, (len(x), 3))
+
+        best_functions = LogicManager().get_best_fit_functions(pd.DataFrame(np.column_stack([x, y_train])),
+                                                               pd.DataFrame(np.column_stack([x, y_ideal])))
+        np.testing.assert_array_equal(best_functions, direct_best_fit(y_train, y_ideal))